@@ -1,18 +1,26 @@
 "API resources."
 
 import base64
+import gzip
+import hashlib
 from http import HTTPStatus as HTTP
-import io
 import mimetypes
 import pathlib
+import queue
+import secrets
+import string
 import tarfile
+import threading
+import time
 
 from fasthtml.common import *
 
+import changes
 import components
 import constants
 import errors
 import items
+import manifest
 import utils
 
 app, rt = components.get_app_rt()
@@ -25,11 +33,28 @@ def get():
 
 
 @rt("/all")
-def get():
-    """Return a JSON dictionary of items {name: {modified, size}} for all items,
-    which includes Markdown files and all other files (PDF, PNG, etc).
+def get(request):
+    """Return a JSON dictionary of items {name: {modified, size, hash}} for all
+    items, which includes Markdown files and all other files (PDF, PNG, etc).
+    The hash of the content is null if not yet computed. The response has
+    an ETag; if it matches 'If-None-Match' in the request, 304 is returned.
+    """
+    etag, result = manifest.get()
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=HTTP.NOT_MODIFIED, headers=dict(ETag=etag))
+    return JSONResponse(result, headers=dict(ETag=etag))
+
+
+@rt("/changes")
+def get(since: int = -1):
+    """Return a JSON dictionary with the list 'changes' of the latest change
+    [sequence number, operation, name] for the files changed after the
+    sequence number 'since', at most a fixed number of changes per call.
+    The 'cursor' is the 'since' value for the next call, and 'more' is true
+    if there are further changes. If 'reset' is true, the changes are not
+    available, and a full sync using '/all' is required.
     """
-    return items.get_all_files()
+    return changes.get(since)
 
 
 @rt("/tags")
@@ -67,12 +92,7 @@ async def post(request):
 async def post(request):
     "Create and add an image."
     data = await request.json()
-    image = items.Image()
-    image.title = data["title"]
-    type = mimetypes.guess_type(data["file"]["name"])[0]
-    if type not in constants.IMAGE_MIMETYPES:
-        raise errors.Error(f"Invalid file type '{type}'", HTTP.UNSUPPORTED_MEDIA_TYPE)
-    image.ext = pathlib.Path(data["file"]["name"]).suffix
+    image = get_file_item("image", data["title"], data["file"]["name"])
     image.tags = data["tags"]
     image.text = data["text"]
     image.content = base64.b64decode(data["file"]["content"].encode("ascii"))
@@ -84,15 +104,7 @@ async def post(request):
 async def post(request):
     "Create and add a file."
     data = await request.json()
-    file = items.File()
-    file.title = data["title"]
-    filename = data["file"]["name"]
-    type = mimetypes.guess_type(filename)[0]
-    if type == constants.MARKDOWN_MIMETYPE:
-        raise errors.Error("Upload of Markdown file is disallowed.")
-    elif type in constants.IMAGE_MIMETYPES:
-        raise errors.Error("Image file must be uploaded as 'image'.")
-    file.ext = filename.suffix
+    file = get_file_item("file", data["title"], data["file"]["name"])
     file.tags = data["tags"]
     file.text = data["text"]
     file.content = base64.b64decode(data["file"]["content"].encode("ascii"))
@@ -100,6 +112,28 @@ async def post(request):
     return {"file": file.id, "url": file.url}
 
 
+def get_file_item(type, title, filename):
+    "Return a new image or file item for the filename, if its MIME type is allowed."
+    mimetype = mimetypes.guess_type(filename)[0]
+    if type == "image":
+        if mimetype not in constants.IMAGE_MIMETYPES:
+            raise errors.Error(
+                f"Invalid file type '{mimetype}'", HTTP.UNSUPPORTED_MEDIA_TYPE
+            )
+        item = items.Image()
+    elif type == "file":
+        if mimetype == constants.MARKDOWN_MIMETYPE:
+            raise errors.Error("Upload of Markdown file is disallowed.")
+        elif mimetype in constants.IMAGE_MIMETYPES:
+            raise errors.Error("Image file must be uploaded as 'image'.")
+        item = items.File()
+    else:
+        raise errors.Error(f"Invalid item type '{type}'")
+    item.title = title
+    item.ext = pathlib.Path(filename).suffix
+    return item
+
+
 @rt("/tag")
 async def post(request):
     "Create and add a tag."
@@ -113,21 +147,206 @@ async def post(request):
     return {"tag": tag.id, "url": tag.url}
 
 
+# Key: upload id; value: hash of the data received so far by this process.
+uploads = {}
+
+
+@rt("/upload")
+def post():
+    """Start a chunked upload; return its identifier.
+    Remove any unfinished uploads older than the maximum age.
+    """
+    now = time.time()
+    for path in constants.UPLOAD_DIR.iterdir():
+        if now - path.stat().st_mtime > constants.UPLOAD_MAX_AGE:
+            path.unlink()
+            uploads.pop(path.name, None)
+    uploadid = secrets.token_hex(16)
+    (constants.UPLOAD_DIR / uploadid).touch()
+    uploads[uploadid] = hashlib.sha256()
+    return {"upload": uploadid}
+
+
+@rt("/upload/{uploadid}")
+def get(uploadid: str):
+    "Return the number of bytes received so far for the upload."
+    return {"upload": uploadid, "offset": get_upload_path(uploadid).stat().st_size}
+
+
+async def put_upload(request):
+    """Append the raw request body to the upload, writing it as it arrives.
+    The offset must equal the number of bytes received so far; if not,
+    409 is returned, and the client should get the offset and resume.
+    A plain Starlette endpoint, since FastHTML reads the whole body into
+    memory before calling a route function.
+    """
+    if response := components.check_auth_before(request, request.session):
+        return response
+    uploadid = request.path_params["uploadid"]
+    try:
+        offset = int(request.query_params.get("offset", 0))
+    except ValueError:
+        raise errors.Error("invalid offset")
+    path = get_upload_path(uploadid)
+    size = path.stat().st_size
+    if offset != size:
+        raise errors.Error(f"offset {offset} is not {size}", HTTP.CONFLICT)
+    digest = uploads.get(uploadid)
+    try:
+        with path.open("ab") as outfile:
+            async for chunk in request.stream():
+                await run_in_threadpool(write_upload_chunk, outfile, digest, chunk)
+                size += len(chunk)
+    except BaseException:
+        # The hash may not match the data written; compute it when finished.
+        uploads.pop(uploadid, None)
+        raise
+    return JSONResponse({"upload": uploadid, "offset": size})
+
+
+app.add_route(Route("/upload/{uploadid}", put_upload, methods=["PUT"]))
+
+
+def write_upload_chunk(outfile, digest, chunk):
+    "Write the chunk to the upload file, and update the hash, if any."
+    outfile.write(chunk)
+    if digest is not None:
+        digest.update(chunk)
+
+
+@rt("/upload/{uploadid}")
+async def post(request, uploadid: str):
+    """Create and add an image or file from the completed upload, given
+    JSON data {type, title, name, tags, text, hash}. If the hash is given,
+    it must be the SHA-256 hex digest of the data received.
+    """
+    data = await request.json()
+    return await run_in_threadpool(finish_upload, uploadid, data)
+
+
+def finish_upload(uploadid, data):
+    """Create the item from the upload; hashing the data, if received partly
+    by a previous process, and moving it into place. Blocking; not to be
+    called from the event loop.
+    """
+    path = get_upload_path(uploadid)
+    try:
+        digest = uploads[uploadid].hexdigest()
+    except KeyError:  # Received partly by a previous process.
+        digest = manifest.compute_hash(path)
+    if data.get("hash") and data["hash"] != digest:
+        raise errors.Error("Hash of uploaded data does not match.")
+    item = get_file_item(data["type"], data["title"], data["name"])
+    item.tags = data.get("tags")
+    item.text = data.get("text") or ""
+    item.move_content(path)
+    uploads.pop(uploadid, None)
+    item.write()
+    manifest.set_hash(item.filepath, digest)
+    return {item.type: item.id, "url": item.url, "hash": digest}
+
+
+def get_upload_path(uploadid):
+    "Return the path of the file for the upload; raise 404 if none."
+    path = constants.UPLOAD_DIR / uploadid
+    if not all(c in string.hexdigits for c in uploadid) or not path.exists():
+        raise errors.Error(f"No such upload '{uploadid}'", HTTP.NOT_FOUND)
+    return path
+
+
 @rt("/download")
 async def post(request):
-    "Return a TGZ file of those items named in the request JSON data."
+    """Return a TGZ file of those items named in the request JSON data.
+    The archive is streamed in chunks as it is written. If 'compress' is
+    false in the request data, an uncompressed TAR file is returned instead;
+    cheaper for images and other already compressed files.
+    """
     data = await request.json()
-    buffer = io.BytesIO()
-    with tarfile.open(fileobj=buffer, mode="w:gz") as tgzfile:
-        for name in data["items"]:
-            path = constants.DATA_DIR / name
-            if not path.suffix:
-                path = path.with_suffix(".md")
+    paths = []
+    for name in data["items"]:
+        path = constants.DATA_DIR / name
+        if not path.suffix:
+            path = path.with_suffix(".md")
+        paths.append(path)
+    compress = data.get("compress", True)
+    return StreamingResponse(
+        get_tar_chunks(paths, compress=compress),
+        media_type=constants.GZIP_MIMETYPE if compress else constants.TAR_MIMETYPE,
+    )
+
+
+class ChunkQueue:
+    "File-like object putting the data written to it into a bounded queue."
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=constants.DOWNLOAD_MAX_CHUNKS)
+        self.cancelled = threading.Event()
+
+    def write(self, data):
+        self.put(bytes(data))
+        return len(data)
+
+    def put(self, chunk):
+        "Put the chunk into the queue, waiting for room unless cancelled."
+        while True:
+            if self.cancelled.is_set():
+                raise IOError("download cancelled")
             try:
-                tgzfile.add(path, arcname=path.name)
-            except FileNotFoundError:
+                self.queue.put(chunk, timeout=1)
+                return
+            except queue.Full:
                 pass
-    return Response(
-        content=buffer.getvalue(),
-        media_type=constants.GZIP_MIMETYPE,
+
+    def flush(self):
+        pass
+
+
+def get_tar_chunks(paths, compress=True):
+    """Generator of the chunks of a TAR file, optionally gzip-compressed,
+    of the given files. The archive is written by a separate thread,
+    at most a fixed number of chunks ahead of the consumer.
+    """
+    chunks = ChunkQueue()
+    thread = threading.Thread(
+        target=write_tar, args=(chunks, paths, compress), daemon=True
     )
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.queue.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        chunks.cancelled.set()
+
+
+def write_tar(chunks, paths, compress):
+    "Write the TAR file of the given files to the chunk queue."
+    try:
+        if compress:
+            outfile = gzip.GzipFile(
+                fileobj=chunks,
+                mode="wb",
+                compresslevel=constants.DOWNLOAD_COMPRESSLEVEL,
+            )
+        else:
+            outfile = chunks
+        with tarfile.open(
+            fileobj=outfile, mode="w|", bufsize=constants.DOWNLOAD_CHUNK_SIZE
+        ) as tarout:
+            for path in paths:
+                try:
+                    tarout.add(path, arcname=path.name)
+                except FileNotFoundError:
+                    pass
+        if compress:
+            outfile.close()
+    except Exception as error:
+        if chunks.cancelled.is_set():
+            return
+        chunks.put(error)
+    else:
+        chunks.put(None)
@@ -0,0 +1,88 @@
+"""Append-only log of changes to the files of the items; for incremental sync.
+Each create, update, delete or restore of a file gets a sequence number.
+The log is kept in memory, and each change is appended to the log file.
+"""
+
+import json
+import threading
+import time
+
+import constants
+
+CREATE = "create"
+UPDATE = "update"
+DELETE = "delete"
+RESTORE = "restore"
+
+# List of tuples (sequence number, operation, name); consecutive numbers.
+log = []
+log_lock = threading.Lock()
+# Sequence number of the first entry in the log.
+first = None
+
+
+def read():
+    """Read the log file. If there is none, the new log starts at a sequence
+    number based on the current time, so that any cursor from a previous log
+    is older than the start of the new log.
+    """
+    global first
+    with log_lock:
+        log.clear()
+        try:
+            with constants.CHANGES_FILE.open() as infile:
+                for line in infile:
+                    try:
+                        log.append(tuple(json.loads(line)))
+                    except ValueError:  # Incomplete last line after a crash.
+                        break
+        except IOError:
+            pass
+        if log:
+            first = log[0][0]
+        else:
+            first = int(time.time() * 1000)
+
+
+def record(operation, *names):
+    "Append the operation on the named files to the log."
+    if first is None:
+        read()
+    with log_lock:
+        with constants.CHANGES_FILE.open("a") as outfile:
+            for name in names:
+                entry = (first + len(log), operation, name)
+                outfile.write(json.dumps(entry) + "\n")
+                log.append(entry)
+
+
+def get_cursor():
+    "Return the sequence number of the latest change."
+    return first + len(log) - 1
+
+
+def get(since):
+    """Return a dictionary with the changes after the given sequence number.
+    Only the latest change of each file in the batch is included. The cursor
+    is the sequence number to give in the next call. If 'reset' is true,
+    the changes since the given number are not available, and the client
+    must do a full sync from '/api/all'.
+    """
+    with log_lock:
+        cursor = get_cursor()
+        if since < first - 1 or since > cursor:
+            return dict(changes=[], cursor=cursor, more=False, reset=True)
+        start = since + 1 - first
+        batch = log[start : start + constants.MAX_CHANGES_BATCH]
+    latest = {}
+    for seq, operation, name in batch:
+        latest.pop(name, None)
+        latest[name] = (seq, operation, name)
+    if batch:
+        cursor = batch[-1][0]
+    return dict(
+        changes=list(latest.values()),
+        cursor=cursor,
+        more=cursor < get_cursor(),
+        reset=False,
+    )
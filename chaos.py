@@ -1,8 +1,7 @@
 "CLI to interact with a remote Chaos server."
 
-import base64
+import hashlib
 from http import HTTPStatus as HTTP
-import json
 import os
 import sys
 
@@ -99,21 +98,7 @@ def link(obj, title, href, tags, text):
 @click.option("--text", **text_args)
 @click.pass_obj
 def image(obj, title, tags, file, text):
-    response = post(
-        obj,
-        "image",
-        get_data(
-            obj,
-            title,
-            tags,
-            text,
-            file=dict(
-                name=file.name,
-                content=base64.b64encode(file.read()).decode("ascii"),
-                encoding="base64",
-            ),
-        ),
-    )
+    response = upload(obj, "image", file, get_data(obj, title, tags, text))
     click.echo(f"Added {obj.server}{response['url']}")
 
 
@@ -129,21 +114,7 @@ def image(obj, title, tags, file, text):
 @click.option("--text", **text_args)
 @click.pass_obj
 def file(obj, title, tags, file, text):
-    response = post(
-        obj,
-        "file",
-        get_data(
-            obj,
-            title,
-            tags,
-            text,
-            file=dict(
-                name=file.name,
-                content=base64.b64encode(file.read()).decode("ascii"),
-                encoding="base64",
-            ),
-        ),
-    )
+    response = upload(obj, "file", file, get_data(obj, title, tags, text))
     click.echo(f"Added {obj.server}{response['url']}")
 
 
@@ -173,7 +144,7 @@ def get(obj, path=None):
 def post(obj, path, data):
     "Server POST call."
     response = requests.post(
-        obj.url(path), headers=dict(password=obj.password), data=json.dumps(data)
+        obj.url(path), headers=dict(password=obj.password), json=data
     )
     if response.status_code in (HTTP.BAD_GATEWAY, HTTP.SERVICE_UNAVAILABLE):
         sys.exit(f"Error: {response.status_code=}")
@@ -184,6 +155,44 @@ def post(obj, path, data):
     return response.json()
 
 
+def upload(obj, type, file, data):
+    """Upload the file in chunks, streamed as raw data, and create the item.
+    A chunk that fails is resumed from the offset reported by the server.
+    """
+    uploadid = post(obj, "upload", {})["upload"]
+    url = obj.url(f"upload/{uploadid}")
+    digest = hashlib.sha256()
+    offset = 0
+    while chunk := file.read(constants.UPLOAD_CHUNK_SIZE):
+        digest.update(chunk)
+        start = offset
+        end = start + len(chunk)
+        for attempt in range(constants.UPLOAD_RETRIES):
+            try:
+                response = requests.put(
+                    url,
+                    params=dict(offset=offset),
+                    data=chunk[offset - start :],
+                    headers=dict(password=obj.password),
+                )
+                if response.status_code == HTTP.OK:
+                    offset = response.json()["offset"]
+                elif response.status_code == HTTP.CONFLICT:
+                    offset = get(obj, f"upload/{uploadid}")["offset"]
+                else:
+                    sys.exit(f"Error: {response.status_code=} {response.content=}")
+            except requests.ConnectionError:
+                offset = get(obj, f"upload/{uploadid}")["offset"]
+            if offset == end:
+                break
+        else:
+            sys.exit(f"Error: upload failed after {constants.UPLOAD_RETRIES} attempts")
+        if obj.verbose:
+            click.echo(f"Uploaded {offset} bytes")
+    data.update(type=type, name=file.name, hash=digest.hexdigest())
+    return post(obj, f"upload/{uploadid}", data)
+
+
 def get_data(obj, title, tags, text, **kwargs):
     "Return the dictionary for a POST call to add an item."
     result = {"title": title}
@@ -1,5 +1,6 @@
 "Components for output generation."
 
+import email.utils
 from http import HTTPStatus as HTTP
 import os
 from urllib.parse import urlsplit
@@ -10,7 +11,9 @@ from fasthtml.pico import Card
 import constants
 import errors
 import items
+import manifest
 import markdown
+import thumbnails
 import utils
 
 
@@ -98,6 +101,57 @@ def redirect(href="/"):
     return RedirectResponse(href, status_code=HTTP.SEE_OTHER)
 
 
+def get_validators(path, immutable=False):
+    """Return the headers ETag, Last-Modified and Cache-Control for the file.
+    The ETag is the content hash if computed, otherwise from mtime and size.
+    Content may change for the same URL, so the browser must revalidate,
+    unless the URL is specified as immutable; i.e. it contains the hash.
+    """
+    stat = path.stat()
+    digest = manifest.get_hash(path, stat.st_mtime, stat.st_size, request=False)
+    if digest is None:
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    else:
+        etag = f'"{digest[:32]}"'
+    if immutable:
+        cache_control = "private, max-age=31536000, immutable"
+    else:
+        cache_control = "private, no-cache"
+    return {
+        "ETag": etag,
+        "Last-Modified": email.utils.formatdate(stat.st_mtime, usegmt=True),
+        "Cache-Control": cache_control,
+    }
+
+
+def is_not_modified(request, headers):
+    """Is the resource with the given validator headers unchanged compared to
+    the version the client has, according to the request headers?
+    """
+    if if_none_match := request.headers.get("If-None-Match"):
+        etags = [e.strip().removeprefix("W/") for e in if_none_match.split(",")]
+        return "*" in etags or headers["ETag"] in etags
+    if if_modified_since := request.headers.get("If-Modified-Since"):
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+            modified = email.utils.parsedate_to_datetime(headers["Last-Modified"])
+        except (TypeError, ValueError):
+            return False
+        return modified <= since
+    return False
+
+
+def get_file_response(request, path, immutable=False, **kwargs):
+    """Return the response for the content of the file, with validators.
+    Return 304 if the client has the current version. Byte ranges are
+    handled by FileResponse.
+    """
+    headers = get_validators(path, immutable=immutable)
+    if is_not_modified(request, headers):
+        return Response(status_code=HTTP.NOT_MODIFIED, headers=headers)
+    return FileResponse(path, headers=headers, **kwargs)
+
+
 def get_icon(filename, title=""):
     return Img(src=f"/static/{filename}", title=title, cls="icon", width=24, height=24)
 
@@ -111,6 +165,30 @@ def get_chaos_icon():
     )
 
 
+def get_image_img(image, cls="display", sizes="100vw", original=True, **kwargs):
+    """Return the Img for the image. If its down-scaled variants are available,
+    they are given in 'srcset', with the original if so specified.
+    """
+    variants = thumbnails.get(image)
+    if not variants:
+        return Img(src=image.url_file, cls=cls, loading="lazy", **kwargs)
+    srcset = [
+        f"{thumbnails.get_url(variants['hash'], w)} {w}w" for w in variants["widths"]
+    ]
+    if original or not srcset:
+        srcset.append(f"{image.url_file} {variants['width']}w")
+    return Img(
+        src=srcset[-1].split()[0],
+        srcset=", ".join(srcset),
+        sizes=sizes,
+        width=variants["width"],
+        height=variants["height"],
+        loading="lazy",
+        cls=cls,
+        **kwargs,
+    )
+
+
 def get_item_icon(item):
     if item.type == "file":
         return get_file_icon(item.mimetype)
@@ -331,7 +409,7 @@ def get_header_item_delete(item):
 
 
 def get_text_card(item, header=None):
-    if html := markdown.to_html(item.text):
+    if html := markdown.get_html(item):
         return Card(header or "", NotStr(html))
     elif header:
         return Card(header)
@@ -414,7 +492,12 @@ def get_items_display(items, title=None, page=None, gallery=False, name="page"):
                             A(
                                 get_image_icon(),
                                 item,
-                                Img(src=item.url_file, cls="autoscale display"),
+                                get_image_img(
+                                    item,
+                                    cls="autoscale display",
+                                    sizes=f"{100 // constants.N_GALLERY_ROW_ITEMS}vw",
+                                    original=False,
+                                ),
                                 href=str(item.url),
                             ),
                         )
@@ -21,7 +21,25 @@ if not DATA_DIR.exists():
     raise OSError(f"DATA_DIR {DATA_DIR} does not exist")
 
 STATE_FILE = DATA_DIR / ".state.yaml"
+STATE_FLUSH_DELAY = 2.0  # Seconds after the last change before writing state file.
+STATE_FLUSH_MAX_DELAY = 10.0  # Seconds after the first change at the latest.
+SNAPSHOT_FILE = DATA_DIR / ".snapshot.pickle"
+SNAPSHOT_FORMAT = 1
+CHANGES_FILE = DATA_DIR / ".changes.log"
+HASHES_FILE = DATA_DIR / ".hashes.json"
 TRASH_DIR = DATA_DIR / "trash"
+UPLOAD_DIR = DATA_DIR / "upload"  # Same file system as the data directory.
+# Generated data, which may be removed at any time.
+THUMBNAIL_DIR = pathlib.Path(
+    os.environ.get("CHAOS_THUMBNAIL_DIR") or DATA_DIR / "thumbnails"
+)
+
+# Check incrementally maintained pointers against a full rebuild on each change.
+VERIFY_POINTERS = bool(os.environ.get("CHAOS_VERIFY_POINTERS"))
+
+# Interval in seconds after which cached file stat values are checked again;
+# for files edited outside of the app. Zero means never.
+STAT_REVALIDATE = float(os.environ.get("CHAOS_STAT_REVALIDATE") or 0)
 
 FILENAME_CHARACTERS = set(string.ascii_letters + string.digits + "-")
 
@@ -40,6 +58,7 @@ TEXT_MIMETYPE = "text/plain"
 MARKDOWN_MIMETYPE = "text/markdown"
 BINARY_MIMETYPE = "application/octet-stream"
 GZIP_MIMETYPE = "application/gzip"
+TAR_MIMETYPE = "application/x-tar"
 PNG_MIMETYPE = "image/png"
 JPEG_MIMETYPE = "image/jpeg"
 SVG_MIMETYPE = "image/svg+xml"
@@ -53,6 +72,7 @@ EPUB_MIMETYPE = "application/epub+zip"
 SQLITE_MIMETYPE = "application/vnd.sqlite3"
 CSV_MIMETYPE = "text/csv"
 JSON_MIMETYPE = "application/json"
+NDJSON_MIMETYPE = "application/x-ndjson"
 
 IMAGE_MIMETYPES = {
     PNG_MIMETYPE,
@@ -62,12 +82,52 @@ IMAGE_MIMETYPES = {
     GIF_MIMETYPE,
 }
 
+# Down-scaled variants of images in these formats; not SVG, nor GIF to keep animation.
+THUMBNAIL_MIMETYPES = {PNG_MIMETYPE, JPEG_MIMETYPE, WEBP_MIMETYPE}
+THUMBNAIL_WIDTHS = (240, 480, 960)
+THUMBNAIL_FORMAT = "WEBP"
+THUMBNAIL_EXT = ".webp"
+THUMBNAIL_QUALITY = 80
+
 MAX_PAGE_ITEMS = 20
 N_GALLERY_ROW_ITEMS = 4
 MAX_RECENT_ITEMS = 6
 
 SCORE_TITLE_WEIGHT = 2.0
 
+RECURRING_FREQUENCIES = ("day", "week", "month", "year")
+MAX_OCCURRENCES_CACHE = 100  # Periods per recurring event.
+
+MAX_HTML_CACHE_SIZE = 20_000_000  # Characters of rendered HTML.
+
+ROWS_PAGE_SIZE = 100  # Rows per page in the database rows view.
+MAX_ROWS_PAGE_SIZE = 1000
+MAX_PAGE_KEYS_CACHE = 100  # Queries for which the keys of pages are kept.
+SQL_TIME_LIMIT = float(os.environ.get("CHAOS_SQL_TIME_LIMIT") or 10)  # Seconds.
+SQL_MAX_ROWS = int(os.environ.get("CHAOS_SQL_MAX_ROWS") or 1000)  # Rows shown.
+SQL_PROGRESS_STEPS = 10000  # Virtual machine steps between checks of the time.
+EXPORT_BATCH_SIZE = 1000  # Rows fetched per chunk of a streamed export.
+CSV_SAMPLE_ROWS = 1000  # Rows of an imported CSV file used to infer column types.
+CSV_BATCH_SIZE = 1000  # Rows inserted per batch when importing a CSV file.
+
+MAX_CHANGES_BATCH = 1000  # Changes per response of the change feed.
+
+DOWNLOAD_CHUNK_SIZE = 65536  # Bytes per chunk of a streamed archive.
+DOWNLOAD_MAX_CHUNKS = 16  # Chunks buffered ahead of the client.
+DOWNLOAD_COMPRESSLEVEL = 6  # Faster than the gzip default 9, nearly as small.
+
+UPLOAD_CHUNK_SIZE = 8_000_000  # Bytes per request of a chunked upload.
+UPLOAD_RETRIES = 3  # Attempts per chunk of an upload.
+UPLOAD_MAX_AGE = 86400  # Seconds after which an unfinished upload is removed.
+
+# Size in bytes of a database file above which the row counts of tables are
+# estimated, rather than counted exactly. Zero means always count exactly.
+DATABASE_ESTIMATE_SIZE = int(os.environ.get("CHAOS_DATABASE_ESTIMATE_SIZE") or 0)
+
+SYNC_WORKERS = 4  # Parallel downloads by the sync script.
+SYNC_BATCH_SIZE = 20_000_000  # Bytes per download batch, unless a single file.
+SYNC_BATCH_COUNT = 500  # Files per download batch.
+
 SVG = "SVG"
 VEGA_LITE = "Vega-Lite"
 VEGA_LITE_LIBRARIES = [
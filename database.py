@@ -1,20 +1,26 @@
 "Database item page."
 
+import collections
 import contextlib
 import copy
 import csv
 import datetime
 from http import HTTPStatus as HTTP
 import io
+import itertools
 import json
 import os
 import pathlib
+import re
+import secrets
 import sqlite3
+import threading
 import urllib.parse
 
 from fasthtml.common import *
 from fasthtml.pico import Card
 
+import changes
 import components
 import constants
 import errors
@@ -109,17 +115,7 @@ def get(database: items.Item, page: int = 1, tags_page: int = 1, refs_page: int
         Main(
             components.get_text_card(database),
             get_overview(database),
-            Card(
-                Form(
-                    Fieldset(
-                        Input(type="text", name="sql", placeholder="SQL command"),
-                        Input(type="submit", value="Execute"),
-                        role="group",
-                    ),
-                    action=f"{database.url}/execute",
-                    method="POST",
-                ),
-            ),
+            Card(get_execute_form(database)),
             Form(
                 components.get_refs_card(database, refs_page),
                 components.get_tags_card(database, tags_page),
@@ -135,22 +131,15 @@ def get(database: items.Item, page: int = 1, tags_page: int = 1, refs_page: int
 
 
 @rt("/{database:Item}{ext:Ext}")
-def get(database: items.Item, ext: str):
+def get(request, database: items.Item, ext: str):
     "Download the content of the database in Sqlite or SQL format."
     assert isinstance(database, items.Database)
     match ext:
         case ".sqlite":
-            return FileResponse(database.filepath)
+            return components.get_file_response(request, database.filepath)
         case ".sql":
-            outfile = io.StringIO()
-            outfile.write(f"/* Database {database.id} */\n\n")
-            with database.connect(readonly=True) as cnx:
-                for line in cnx.iterdump():
-                    outfile.write(line)
-                    outfile.write("\n")
-            return Response(
-                content=outfile.getvalue(),
-                status_code=HTTP.OK,
+            return StreamingResponse(
+                get_dump_chunks(database),
                 headers={
                     "Content-Type": constants.TEXT_MIMETYPE,
                     "Content-Disposition": f'attachment; filename="{database.id}.sql"',
@@ -258,6 +247,10 @@ def get(database: items.Item, relname: str):
     assert isinstance(database, items.Database)
     schema = database.get_schema()
     title = f"{schema[relname]['type'].capitalize()} {relname}"
+    columns = [
+        dict(title=name, field=name, headerFilter="input")
+        for name in schema[relname]["columns"]
+    ]
     return (
         Title(title),
         Link(
@@ -279,7 +272,7 @@ def get(database: items.Item, relname: str):
         ),
         Main(
             Card(
-                Header(f"{schema[relname]['count']} rows", cls="center"),
+                Header(f"{get_count_display(schema[relname])} rows", cls="center"),
                 Div(id="table"),
             ),
             cls="container",
@@ -300,49 +293,65 @@ def get(database: items.Item, relname: str):
         Script(
             f"""var table = new Tabulator("#table", {{
 height: 500,
-autoColumns: true,
-ajaxURL: "{database.url}/rows/{relname}.json",
-ajaxResponse: function(url, params, response) {{return response.data}},
+columns: {json.dumps(columns)},
+pagination: true,
+paginationMode: "remote",
+paginationSize: {constants.ROWS_PAGE_SIZE},
+sortMode: "remote",
+filterMode: "remote",
+ajaxURL: "{database.url}/rows/{relname}/page",
 }});""",
             type="text/javascript",
         ),
     )
 
 
+@rt("/{database:Item}/rows/{relname:Name}/page")
+def get(request, database: items.Item, relname: str, page: int = 1, size: int = 0):
+    """Return a page of the table or view rows for Tabulator in remote mode;
+    sorted and filtered as given by the parameters 'sort' and 'filter'.
+    """
+    assert isinstance(database, items.Database)
+    schema = database.get_schema()
+    try:
+        relation = schema[relname]
+    except KeyError:
+        raise errors.Error(f"No such relation '{relname}'", HTTP.NOT_FOUND)
+    size = min(max(1, size or constants.ROWS_PAGE_SIZE), constants.MAX_ROWS_PAGE_SIZE)
+    page = max(1, page)
+    params = get_nested_params(request.query_params)
+    sorters = [
+        (s["field"], s.get("dir") == "desc") for s in params.get("sort", [])
+    ]
+    filters = [
+        (f["field"], f.get("type", "like"), f.get("value", ""))
+        for f in params.get("filter", [])
+    ]
+    rows, count = get_rows_page(
+        database, relname, relation, page, size, sorters, filters
+    )
+    columns = list(relation["columns"].keys())
+    return {
+        "last_page": max(1, (count - 1) // size + 1),
+        "last_row": count,
+        "data": [dict(zip(columns, row)) for row in rows],
+    }
+
+
 @rt("/{database:Item}/rows/{relname:Name}{ext:Ext}")
 def get(database: items.Item, relname: str, ext: str):
-    "Download the table or view rows in CSV or JSON format."
+    "Download the table or view rows in CSV, JSON or NDJSON format; streamed."
     assert isinstance(database, items.Database)
     schema = database.get_schema()
     columns = list(schema[relname]["columns"].keys())
-    match ext:
-        case ".csv":
-            outfile = io.StringIO()
-            writer = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
-            writer.writerow(columns)
-            with database.connect(readonly=True) as cnx:
-                sql = f"SELECT {','.join(columns)} FROM {relname}"
-                writer.writerows(cnx.execute(sql))
-            outfile.seek(0)
-            content = outfile.read().encode("utf-8")
-            return Response(
-                headers={
-                    "Content-Type": f"{constants.CSV_MIMETYPE}; charset=utf-8",
-                    "Content-Disposition": f'attachment; filename="{database.id}_{relname}.csv"',
-                },
-                content=content,
-                status_code=HTTP.OK,
-            )
-        case ".json":
-            with database.connect(readonly=True) as cnx:
-                sql = f"SELECT {','.join(columns)} FROM {relname}"
-                rows = cnx.execute(sql).fetchall()
-            return {
-                "$id": f"database {database.id}; {schema[relname]['type']} {relname}",
-                "data": [dict(zip(columns, row)) for row in rows],
-            }
-        case _:
-            raise errors.Error("invalid format", HTTP.NOT_FOUND)
+    sql = f"SELECT {','.join(columns)} FROM {relname}"
+    return get_export_response(
+        database,
+        sql,
+        ext,
+        f"{database.id}_{relname}",
+        {"$id": f"database {database.id}; {schema[relname]['type']} {relname}"},
+    )
 
 
 @rt("/{database:Item}/rows/{tablename:str}/csv")
@@ -379,6 +388,7 @@ def get(database: items.Item, tablename: str):
                         id="file-helper",
                     ),
                 ),
+                *get_import_fields(database),
                 Input(type="submit", value="Add CSV file"),
                 action=f"{database.url}/rows/{tablename}/csv",
                 method="POST",
@@ -390,44 +400,49 @@ def get(database: items.Item, tablename: str):
 
 
 @rt("/{database:Item}/rows/{tablename:str}/csv")
-async def post(database: items.Item, tablename: str, upfile: UploadFile):
-    "Actually add data to the table from a CSV file."
+def post(
+    session,
+    database: items.Item,
+    tablename: str,
+    upfile: UploadFile,
+    importid: str = None,
+):
+    """Actually add data to the table from a CSV file.
+    The file is read and inserted in batches, in one transaction.
+    The progress is available using the import id.
+    """
     assert isinstance(database, items.Database)
     table_columns = database.get_schema()[tablename]["columns"]
-    required_table_columns = dict(
-        [(n, c) for n, c in table_columns.items() if not c["null"]]
-    )
-    csv_columns, rows = parse_csv_content(await upfile.read())
-    csv_column_names = [c["name"] for c in csv_columns]
-    csv_data = [dict(zip(csv_column_names, row)) for row in rows]
-    csv_columns = dict([(c["name"], c) for c in csv_columns])
-    used_columns = list(set(table_columns.keys()).intersection(csv_column_names))
+    timer = Timer()
     try:
-        for name, column in required_table_columns.items():
-            if name not in csv_columns:
-                raise KeyError(f"missing column {name} in CSV file")
-            if csv_columns[name]["null"]:
-                raise ValueError(
-                    f"column {name} in CSV file contains disallowed NULL value"
-                )
-            if column["type"] == "TEXT":
-                for data in csv_data:
-                    if not data[name]:
-                        raise ValueError(
-                            f"column {name} in CSV file contains disallowed empty string value"
-                        )
-        for name in used_columns:
-            if table_columns[name]["type"] != csv_columns[name]["type"]:
-                raise ValueError(f"wrong type for column {name}")
-        rows = [[data[n] for n in used_columns] for data in csv_data]
+        reader = get_csv_reader(upfile)
+        header = next(reader, [])
+        for name, column in table_columns.items():
+            if not column["null"] and name not in header:
+                raise ValueError(f"missing column {name} in CSV file")
+        positions = [pos for pos, name in enumerate(header) if name in table_columns]
+        columns = [
+            dict(
+                name=header[pos],
+                type=table_columns[header[pos]]["type"],
+                null=table_columns[header[pos]]["null"],
+            )
+            for pos in positions
+        ]
+        rows = (
+            [row[pos] for pos in positions] for row in get_csv_rows(reader, header)
+        )
         with set_modified_when_changed(database):
             with database.connect() as cnx:
-                columns = ",".join(used_columns)
-                values = ",".join(["?"] * len(used_columns))
-                sql = f"INSERT INTO {tablename} ({columns}) VALUES ({values})"
-                cnx.executemany(sql, rows)
-    except (KeyError, ValueError) as error:
+                cnx.execute("BEGIN")
+                count = insert_csv_rows(
+                    cnx, tablename, columns, rows, importid=importid
+                )
+    except (ValueError, csv.Error, sqlite3.Error) as error:
         raise errors.Error(error)
+    add_toast(
+        session, f"{count} rows added in {timer.elapsed:.1f} seconds.", "success"
+    )
     return components.redirect(database.url)
 
 
@@ -473,6 +488,7 @@ def get(database: items.Item):
                         id="file-helper",
                     ),
                 ),
+                *get_import_fields(database),
                 Input(type="submit", value="Upload"),
                 action=f"{database.url}/csv",
                 method="POST",
@@ -484,50 +500,90 @@ def get(database: items.Item):
 
 
 @rt("/{database:Item}/csv")
-async def post(database: items.Item, tablename: str, upfile: UploadFile):
+def post(
+    session,
+    database: items.Item,
+    tablename: str,
+    upfile: UploadFile,
+    importid: str = None,
+):
     """Actually create a table from CSV file upload.
-    Determine columns from header and data.
+    Determine columns from header and a sample of the data. The file is
+    read and inserted in batches, in one transaction. The progress is
+    available using the import id.
     """
     assert isinstance(database, items.Database)
-    columns, rows = parse_csv_content(await upfile.read())
+    timer = Timer()
     try:
+        reader = get_csv_reader(upfile)
+        header = next(reader, [])
+        if not header:
+            raise ValueError("no header in CSV file")
+        rows = get_csv_rows(reader, header)
+        sample = list(itertools.islice(rows, constants.CSV_SAMPLE_ROWS))
+        columns = [dict(name=name, type="INTEGER", null=False) for name in header]
+        for row in sample:
+            widen_csv_columns(columns, row)
         with set_modified_when_changed(database):
             with database.connect() as cnx:
-                sql = ", ".join([c["sql"] for c in columns])
-                cnx.execute(f"CREATE TABLE {tablename} ({sql})")
-                values = ",".join(["?"] * len(columns))
-                columns = ",".join([c["name"] for c in columns])
-                sql = f"INSERT INTO {tablename} ({columns}) VALUES ({values})"
-                cnx.executemany(sql, rows)
-    except sqlite3.Error as error:
+                cnx.execute("BEGIN")
+                cnx.execute(f"CREATE TABLE {tablename} ({get_csv_table_sql(columns)})")
+                count = insert_csv_rows(
+                    cnx,
+                    tablename,
+                    columns,
+                    itertools.chain(sample, rows),
+                    widen=True,
+                    importid=importid,
+                )
+    except (ValueError, csv.Error, sqlite3.Error) as error:
         raise errors.Error(error)
+    add_toast(
+        session, f"{count} rows added in {timer.elapsed:.1f} seconds.", "success"
+    )
     return components.redirect(database.url)
 
 
+@rt("/{database:Item}/csv/{importid:Name}/progress")
+def get(database: items.Item, importid: str):
+    "Return the number of rows added so far by the CSV import, if in progress."
+    assert isinstance(database, items.Database)
+    with importing_lock:
+        count = importing.get(importid)
+    if count is None:
+        return ""
+    return Small(f"{count} rows added so far...")
+
+
 @rt("/{database:Item}/execute")
-def post(database: items.Item, sql: str = None):
-    "Execute a SQL command."
+def post(database: items.Item, sql: str = None, queryid: str = None):
+    """Execute a SQL command. The time is limited, as is the number of rows
+    of the result shown. The command may be cancelled using its query id.
+    """
     assert isinstance(database, items.Database)
     column_names = []
     result = []
     error_card = ""
+    statistics = None
     if sql:
         with set_modified_when_changed(database):
             with database.connect() as cnx:
                 try:
-                    cursor = cnx.execute(sql)
+                    column_names, result, statistics = execute_bounded(
+                        cnx, sql, queryid
+                    )
                 except sqlite3.Error as error:
                     error_card = Card(
                         Header("Error", style="color: red;"), Pre(str(error))
                     )
-                else:
-                    result = cursor.fetchall()
-                    if cursor.description:
-                        column_names = [t[0] for t in cursor.description]
     if column_names or result:
+        if statistics["truncated"]:
+            count = f"First {len(result)} rows; truncated"
+        else:
+            count = f"{len(result)} rows"
         result_card = Card(
             Header(
-                Span(f"{len(result)} rows", cls="center strong"),
+                Span(count, cls="center strong"),
                 Form(
                     Input(type="hidden", name="sql", value=sql),
                     Input(type="submit", value="Add view"),
@@ -547,12 +603,29 @@ def post(database: items.Item, sql: str = None):
                     method="POST",
                     action=f"{database.url}/execute.json",
                 ),
+                Form(
+                    Input(type="hidden", name="sql", value=sql),
+                    Input(
+                        type="submit", value="Download NDJSON", cls="secondary outline"
+                    ),
+                    method="POST",
+                    action=f"{database.url}/execute.ndjson",
+                ),
                 cls="grid",
             ),
             Table(
                 Thead(*[Tr(*[Th(c) for c in column_names])]),
                 Tbody(*[Tr(*[Td(v) for v in row]) for row in result]),
             ),
+            Footer(
+                f"{statistics['elapsed']:.3f} s; ",
+                (
+                    f"~{statistics['steps']:,d}"
+                    if statistics["steps"]
+                    else f"< {constants.SQL_PROGRESS_STEPS:,d}"
+                ),
+                " virtual machine steps",
+            ),
         )
     else:
         result_card = Card(I("No result."))
@@ -574,22 +647,7 @@ def post(database: items.Item, sql: str = None):
         ),
         Main(
             get_overview(database),
-            Card(
-                Form(
-                    Fieldset(
-                        Input(
-                            type="text",
-                            name="sql",
-                            value=sql or "",
-                            placeholder="SQL command",
-                        ),
-                        Input(type="submit", value="Execute"),
-                        role="group",
-                    ),
-                    action=f"{database.url}/execute",
-                    method="POST",
-                ),
-            ),
+            Card(get_execute_form(database, sql)),
             error_card,
             result_card,
             cls="container",
@@ -597,44 +655,31 @@ def post(database: items.Item, sql: str = None):
     )
 
 
+@rt("/{database:Item}/execute/{queryid:Name}/cancel")
+def post(database: items.Item, queryid: str):
+    "Cancel the SQL command being executed, if any."
+    assert isinstance(database, items.Database)
+    with running_lock:
+        try:
+            running[queryid].interrupt()
+        except KeyError:
+            pass
+    return ""
+
+
 @rt("/{database:Item}/execute{ext:Ext}")
 def post(database: items.Item, sql: str, ext: str):
-    "Execute a SQL command and download the result as CSV or JSON."
+    "Execute a SQL command and download the result as CSV, JSON or NDJSON; streamed."
     assert isinstance(database, items.Database)
     assert sql
-    with set_modified_when_changed(database):
-        with database.connect() as cnx:
-            try:
-                cursor = cnx.execute(sql)
-            except sqlite3.Error as error:
-                errors.Error(str(error))
-            else:
-                header = [t[0] for t in cursor.description]
-                rows = cursor.fetchall()
-    match ext:
-        case ".csv":
-            outfile = io.StringIO()
-            writer = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
-            writer.writerow(header)
-            writer.writerows(rows)
-            outfile.seek(0)
-            content = outfile.read().encode("utf-8")
-            return Response(
-                content=content,
-                status_code=HTTP.OK,
-                headers={
-                    "Content-Type": constants.CSV_MIMETYPE,
-                    "Content-Disposition": f'attachment; filename="query.csv"',
-                },
-            )
-        case ".json":
-            return {
-                "$id": f"database {database.id}",
-                "query": sql,
-                "data": [dict(zip(header, row)) for row in rows],
-            }
-        case _:
-            raise errors.Error("invalid format", HTTP.NOT_FOUND)
+    return get_export_response(
+        database,
+        sql,
+        ext,
+        "query",
+        {"$id": f"database {database.id}", "query": sql},
+        readonly=False,
+    )
 
 
 @rt("/{database:Item}/edit")
@@ -825,6 +870,9 @@ def get_overview(database):
         operations.append(
             Li(A("Download JSON", href=f"{database.url}/rows/{relname}.json"))
         )
+        operations.append(
+            Li(A("Download NDJSON", href=f"{database.url}/rows/{relname}.ndjson"))
+        )
         rows.append(
             Div(
                 Details(
@@ -837,7 +885,7 @@ def get_overview(database):
                     Ul(*spec),
                 ),
                 Details(
-                    Summary(f"{relation['count']} rows"),
+                    Summary(f"{get_count_display(relation)} rows"),
                     Ul(*operations),
                     cls="dropdown",
                 ),
@@ -847,53 +895,498 @@ def get_overview(database):
     return Card(*rows)
 
 
-def parse_csv_content(content):
-    """Read the CSV content and figure out the SQL for the corresponding table.
-    Return tuple (columns, rows) where 'columns' is the definition and 'rows' the data.
+# Column types inferred from CSV data, from narrowest to widest.
+CSV_TYPES = ("INTEGER", "REAL", "TEXT")
+CSV_CONVERTERS = dict(INTEGER=int, REAL=float, TEXT=str)
+
+
+# Key: import id; value: number of rows of the CSV file inserted so far.
+importing = {}
+importing_lock = threading.Lock()
+
+
+def get_import_fields(database):
+    """Return the hidden input field for the import id of a CSV file upload,
+    and the element displaying the progress of the import, polled by htmx.
     """
-    reader = csv.reader(io.StringIO(content.decode("utf-8")))
-    header = next(reader)
-    rows = list(reader)
-    columns = []
-    for pos, name in enumerate(header):
-        column = dict(name=name, type="INTEGER", null=False)
-        columns.append(column)
-        try:
-            for row in rows:
-                if value := row[pos]:
-                    row[pos] = int(value)
-                else:
-                    row[pos] = None
-                    column["null"] = True
-        except ValueError:
+    importid = secrets.token_hex(8)
+    return (
+        Input(type="hidden", name="importid", value=importid),
+        Div(
+            hx_get=f"{database.url}/csv/{importid}/progress",
+            hx_trigger="every 1s",
+        ),
+    )
+
+
+def get_csv_reader(upfile):
+    "Return a CSV reader reading the uploaded file incrementally."
+    upfile.file.seek(0)
+    return csv.reader(io.TextIOWrapper(upfile.file, encoding="utf-8", newline=""))
+
+
+def get_csv_rows(reader, header):
+    """Generator of the rows from the CSV reader, skipping empty lines.
+    Raise ValueError if a row does not have the same number of values as the header.
+    """
+    for row in reader:
+        if not row:
+            continue
+        if len(row) != len(header):
+            raise ValueError(
+                f"line {reader.line_num} in CSV file has {len(row)} values,"
+                f" not {len(header)}"
+            )
+        yield row
+
+
+def get_csv_table_sql(columns):
+    "Return the SQL for the definition of the columns of a table from CSV data."
+    return ", ".join(
+        [f"{c['name']} {c['type']} {'' if c['null'] else 'NOT NULL'}" for c in columns]
+    )
+
+
+def widen_csv_columns(columns, row):
+    """Widen the types of the columns, or allow NULL, as required by the values
+    of the CSV row. Return True if any column was changed.
+    """
+    changed = False
+    for column, value in zip(columns, row):
+        if not value:
+            if not column["null"]:
+                column["null"] = True
+                changed = True
+            continue
+        while True:
             try:
-                for row in rows:
-                    if value := row[pos]:
-                        row[pos] = float(value)
-                    else:
-                        row[pos] = None
-                        column["null"] = True
-                column["type"] = "REAL"
+                CSV_CONVERTERS[column["type"]](value)
+                break
             except ValueError:
-                for row in rows:
-                    if not value:
-                        row[pos] = None
-                        column["null"] = True
-                column["type"] = "TEXT"
-    for column in columns:
-        column["sql"] = (
-            f"{column['name']} {column['type']} {'' if column['null'] else 'NOT NULL'}"
-        )
-    return columns, rows
+                column["type"] = CSV_TYPES[CSV_TYPES.index(column["type"]) + 1]
+                changed = True
+    return changed
+
+
+def convert_csv_row(columns, row):
+    """Return the values of the CSV row converted to the types of the columns;
+    an empty value is NULL. Raise ValueError if a value does not fit.
+    """
+    result = []
+    for column, value in zip(columns, row):
+        if value:
+            try:
+                result.append(CSV_CONVERTERS.get(column["type"], str)(value))
+            except ValueError:
+                raise ValueError(
+                    f"wrong type for column {column['name']} in CSV file: '{value}'"
+                )
+        elif column["null"]:
+            result.append(None)
+        else:
+            raise ValueError(
+                f"column {column['name']} in CSV file contains disallowed empty value"
+            )
+    return result
+
+
+def insert_csv_rows(cnx, tablename, columns, rows, widen=False, importid=None):
+    """Insert the CSV rows into the table in batches of fixed size.
+    Return the number of rows inserted. If 'widen' is true, a value that
+    does not fit its column widens the type or allows NULL, and the table,
+    which must have been created from the columns, is redefined accordingly.
+    If the import id is given, the number of rows inserted so far is
+    recorded after each batch.
+    """
+    count = 0
+    batch = []
+    try:
+        for row in rows:
+            try:
+                batch.append(convert_csv_row(columns, row))
+            except ValueError:
+                if not widen:
+                    raise
+                count += insert_csv_batch(cnx, tablename, columns, batch)
+                batch = []
+                widen_csv_columns(columns, row)
+                redefine_csv_table(cnx, tablename, columns)
+                batch.append(convert_csv_row(columns, row))
+            if len(batch) >= constants.CSV_BATCH_SIZE:
+                count += insert_csv_batch(cnx, tablename, columns, batch)
+                batch = []
+                if importid:
+                    with importing_lock:
+                        importing[importid] = count
+        count += insert_csv_batch(cnx, tablename, columns, batch)
+    finally:
+        if importid:
+            with importing_lock:
+                importing.pop(importid, None)
+    return count
+
+
+def insert_csv_batch(cnx, tablename, columns, batch):
+    "Insert the batch of converted rows into the table; return the number of rows."
+    if batch:
+        names = ",".join([c["name"] for c in columns])
+        values = ",".join("?" * len(columns))
+        cnx.executemany(f"INSERT INTO {tablename} ({names}) VALUES ({values})", batch)
+    return len(batch)
+
+
+def redefine_csv_table(cnx, tablename, columns):
+    """Redefine the table created from CSV data with the widened columns,
+    copying the rows inserted so far. Done rarely, if the sample was misleading.
+    """
+    tmpname = f"_{tablename}_csv"
+    cnx.execute(f"CREATE TABLE {tmpname} ({get_csv_table_sql(columns)})")
+    cnx.execute(f"INSERT INTO {tmpname} SELECT * FROM {tablename}")
+    cnx.execute(f"DROP TABLE {tablename}")
+    cnx.execute(f"ALTER TABLE {tmpname} RENAME TO {tablename}")
+
+
+# Filter types of Tabulator and their SQL operators.
+FILTER_OPERATORS = {
+    "=": "=",
+    "!=": "!=",
+    "<": "<",
+    "<=": "<=",
+    ">": ">",
+    ">=": ">=",
+    "like": "LIKE",
+    "starts": "LIKE",
+    "ends": "LIKE",
+}
+
+# Query parameter as sent by Tabulator; 'name[i][key]'.
+NESTED_PARAM = re.compile(r"(\w+)\[(\d+)\]\[(\w+)\]")
+
+# Key: query; value: dictionary with the row count and the last key of each page.
+# Least recently used queries are discarded first.
+page_keys = collections.OrderedDict()
+page_keys_lock = threading.Lock()
+
+
+def get_nested_params(query_params):
+    """Return the query parameters 'name[i][key]=value' as a dictionary
+    {name: [{key: value}, ...]}, as sent by Tabulator for sort and filter.
+    """
+    result = {}
+    for param, value in query_params.multi_items():
+        if match := NESTED_PARAM.fullmatch(param):
+            name, pos, key = match.groups()
+            entries = result.setdefault(name, {})
+            entries.setdefault(int(pos), {})[key] = value
+    return dict([(n, [e[p] for p in sorted(e)]) for n, e in result.items()])
+
+
+def get_rows_page(database, relname, relation, page, size, sorters, filters):
+    """Return the tuple (rows, count) for the page of the rows of the relation,
+    and the number of rows matching the filters. The count is exact; it is
+    computed once for the query, and is valid until the database changes.
+    When the last key of the previous page is known from an earlier request
+    for the same query, the page is fetched by keyset pagination, which uses
+    the index on the sort column, if any. Otherwise by offset.
+    """
+    columns = list(relation["columns"].keys())
+    for field in [s[0] for s in sorters] + [f[0] for f in filters]:
+        if field not in columns:
+            raise errors.Error(f"No such column '{field}'")
+    # Keyset pagination needs a unique key; the rowid. Only a single sort column.
+    keyset = (
+        relation["type"] == "table"
+        and "without rowid" not in relation["sql"].lower()
+        and len(sorters) <= 1
+    )
+    selected = ", ".join([f'"{c}"' for c in columns])
+    if keyset:
+        selected += ", rowid"
+    where = []
+    values = []
+    for field, type, value in filters:
+        try:
+            operator = FILTER_OPERATORS[type]
+        except KeyError:
+            raise errors.Error(f"Invalid filter type '{type}'")
+        if type == "like":
+            value = f"%{value}%"
+        elif type == "starts":
+            value = f"{value}%"
+        elif type == "ends":
+            value = f"%{value}"
+        where.append(f'"{field}" {operator} ?')
+        values.append(value)
+    order = [f'"{field}" {"DESC" if desc else "ASC"}' for field, desc in sorters]
+    descending = bool(sorters) and sorters[0][1]
+    if keyset:
+        order.append(f"rowid {'DESC' if descending else 'ASC'}")
+
+    # The keys of the pages are valid only as long as the database is unchanged.
+    stat = database.filepath.stat()
+    key = (
+        database.id,
+        relname,
+        tuple(sorters),
+        tuple(filters),
+        size,
+        stat.st_mtime_ns,
+        stat.st_size,
+    )
+    with page_keys_lock:
+        query = page_keys.pop(key, None)
+        if query is not None:
+            page_keys[key] = query
+    with database.connect(readonly=True) as cnx:
+        if query is None:
+            # The estimated count of rows is no good for the last page.
+            if filters or relation["estimated"]:
+                sql = f"SELECT COUNT(*) FROM {relname}"
+                if filters:
+                    sql += f" WHERE {' AND '.join(where)}"
+                count = cnx.execute(sql, values).fetchone()[0]
+            else:
+                count = relation["count"]
+            query = dict(count=count, keys={})
+            with page_keys_lock:
+                page_keys[key] = query
+                while len(page_keys) > constants.MAX_PAGE_KEYS_CACHE:
+                    page_keys.popitem(last=False)
+
+        previous = query["keys"].get(page - 1) if keyset else None
+        if previous is not None and None not in previous:
+            if sorters and descending:
+                # Null sorts last when descending, and compares as unknown.
+                field = sorters[0][0]
+                where.append(f'(("{field}", rowid) < (?, ?) OR "{field}" IS NULL)')
+            elif sorters:
+                where.append(f'("{sorters[0][0]}", rowid) > (?, ?)')
+            else:
+                where.append("rowid > ?")
+            values.extend(previous)
+            limit = "LIMIT ?"
+            values.append(size)
+        else:
+            limit = "LIMIT ? OFFSET ?"
+            values.extend([size, (page - 1) * size])
+        sql = f"SELECT {selected} FROM {relname}"
+        if where:
+            sql += f" WHERE {' AND '.join(where)}"
+        if order:
+            sql += f" ORDER BY {', '.join(order)}"
+        rows = cnx.execute(f"{sql} {limit}", values).fetchall()
+
+    if keyset and rows:
+        last = rows[-1]
+        if sorters:
+            query["keys"][page] = (last[columns.index(sorters[0][0])], last[-1])
+        else:
+            query["keys"][page] = (last[-1],)
+    if keyset:
+        rows = [row[:-1] for row in rows]
+    return rows, query["count"]
+
+
+# Key: query id; value: connection executing the query. For cancelling.
+running = {}
+running_lock = threading.Lock()
+
+
+def get_execute_form(database, sql=None):
+    """Return the form for executing a SQL command. It has a button for
+    cancelling the command while it is executing.
+    """
+    queryid = secrets.token_hex(8)
+    return Form(
+        Fieldset(
+            Input(
+                type="text",
+                name="sql",
+                value=sql or "",
+                placeholder="SQL command",
+            ),
+            Input(type="hidden", name="queryid", value=queryid),
+            Input(type="submit", value="Execute"),
+            Button(
+                "Cancel",
+                type="button",
+                cls="secondary",
+                hx_post=f"{database.url}/execute/{queryid}/cancel",
+                hx_swap="none",
+            ),
+            role="group",
+        ),
+        action=f"{database.url}/execute",
+        method="POST",
+    )
+
+
+def execute_bounded(cnx, sql, queryid=None):
+    """Execute the SQL command, aborting it if it takes longer than the time
+    limit, or if cancelled using the query id. At most the maximum number
+    of rows of the result is fetched.
+    Return the tuple (column names, rows, statistics).
+    """
+    timer = Timer()
+    with limit_time(cnx, queryid=queryid) as progress:
+        cursor = cnx.execute(sql)
+        rows = cursor.fetchmany(constants.SQL_MAX_ROWS + 1)
+    column_names = [t[0] for t in cursor.description or []]
+    statistics = dict(
+        truncated=len(rows) > constants.SQL_MAX_ROWS,
+        elapsed=timer.elapsed,
+        steps=progress["steps"],
+    )
+    return column_names, rows[: constants.SQL_MAX_ROWS], statistics
+
+
+@contextlib.contextmanager
+def limit_time(cnx, queryid=None):
+    """Abort the SQL operations on the connection within the context if they
+    take longer than the time limit, or if cancelled using the query id.
+    Yield a dictionary with the number of virtual machine steps executed.
+    """
+    timer = Timer()
+    progress = dict(steps=0)
+
+    def handler():
+        progress["steps"] += constants.SQL_PROGRESS_STEPS
+        return timer.elapsed > constants.SQL_TIME_LIMIT
+
+    cnx.set_progress_handler(handler, constants.SQL_PROGRESS_STEPS)
+    if queryid:
+        with running_lock:
+            running[queryid] = cnx
+    try:
+        yield progress
+    except sqlite3.OperationalError as error:
+        if timer.elapsed > constants.SQL_TIME_LIMIT:
+            raise sqlite3.OperationalError(
+                f"{error}; time limit {constants.SQL_TIME_LIMIT} seconds exceeded"
+            )
+        raise
+    finally:
+        cnx.set_progress_handler(None, 0)
+        if queryid:
+            with running_lock:
+                running.pop(queryid, None)
+
+
+def fetch_batches(cnx, cursor):
+    """Generator of batches of rows from the cursor. The time limit applies
+    to the fetching of each batch, not to the consumer of the batches.
+    """
+    while True:
+        with limit_time(cnx):
+            rows = cursor.fetchmany(constants.EXPORT_BATCH_SIZE)
+        if not rows:
+            return
+        yield rows
+
+
+# Key: export format; value: MIME type.
+EXPORT_MIMETYPES = {
+    ".csv": f"{constants.CSV_MIMETYPE}; charset=utf-8",
+    ".json": constants.JSON_MIMETYPE,
+    ".ndjson": constants.NDJSON_MIMETYPE,
+}
+
+
+def get_export_response(database, sql, ext, filename, meta, readonly=True):
+    """Return the streaming response for the result of the SQL query in the format
+    given by the extension. The query is executed before the response is returned,
+    so that an error in it is reported as such.
+    """
+    try:
+        mimetype = EXPORT_MIMETYPES[ext]
+    except KeyError:
+        raise errors.Error("invalid format", HTTP.NOT_FOUND)
+    chunks = get_export_chunks(database, sql, ext, meta, readonly=readonly)
+    first = next(chunks)
+    return StreamingResponse(
+        itertools.chain([first], chunks),
+        headers={
+            "Content-Type": mimetype,
+            "Content-Disposition": f'attachment; filename="{filename}{ext}"',
+        },
+    )
+
+
+def get_export_chunks(database, sql, ext, meta, readonly=True):
+    """Generator of the encoded chunks of the result of the SQL query in CSV,
+    JSON or NDJSON format. The rows are fetched in batches, each within
+    the time limit. The connection is used from the threads that iterate
+    over the response.
+    """
+    if readonly:
+        modified = contextlib.nullcontext()
+    else:
+        modified = set_modified_when_changed(database)
+    with modified, database.connect(readonly=readonly, threaded=True) as cnx:
+        try:
+            with limit_time(cnx):
+                cursor = cnx.execute(sql)
+        except sqlite3.Error as error:
+            raise errors.Error(str(error))
+        columns = [t[0] for t in cursor.description or []]
+        match ext:
+            case ".csv":
+                outfile = io.StringIO()
+                writer = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
+                writer.writerow(columns)
+                yield outfile.getvalue().encode("utf-8")
+                for rows in fetch_batches(cnx, cursor):
+                    outfile.seek(0)
+                    outfile.truncate()
+                    writer.writerows(rows)
+                    yield outfile.getvalue().encode("utf-8")
+            case ".json":
+                yield (json.dumps(meta)[:-1] + ', "data": [').encode("utf-8")
+                separator = "\n"
+                for rows in fetch_batches(cnx, cursor):
+                    chunk = [separator]
+                    for row in rows:
+                        chunk.append(json.dumps(dict(zip(columns, row))))
+                        chunk.append(",\n")
+                    separator = chunk.pop()
+                    yield "".join(chunk).encode("utf-8")
+                yield "\n]}".encode("utf-8")
+            case ".ndjson":
+                yield b""
+                for rows in fetch_batches(cnx, cursor):
+                    yield "".join(
+                        [json.dumps(dict(zip(columns, row))) + "\n" for row in rows]
+                    ).encode("utf-8")
+
+
+def get_dump_chunks(database):
+    "Generator of the encoded chunks of the SQL dump of the database."
+    with database.connect(readonly=True, threaded=True) as cnx:
+        lines = [f"/* Database {database.id} */\n"]
+        for line in cnx.iterdump():
+            lines.append(line)
+            if len(lines) >= constants.EXPORT_BATCH_SIZE:
+                yield ("\n".join(lines) + "\n").encode("utf-8")
+                lines = []
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def get_count_display(relation):
+    "Return the number of rows of the relation for display; marked if estimated."
+    if relation["estimated"]:
+        return f"~{relation['count']}"
+    return str(relation["count"])
 
 
 @contextlib.contextmanager
 def set_modified_when_changed(database):
     "Set the modified timestamp of the item if the database file changes."
-    before = database.filepath.stat().st_mtime
+    before = database.stat(database.filepath, refresh=True)[0]
     try:
         yield database
     finally:
-        after = database.filepath.stat().st_mtime
+        after = database.stat(database.filepath, refresh=True)[0]
         if after != before:
             os.utime(database.path, (database.path.stat().st_atime, after))
+            database.stat(refresh=True)
+            changes.record(changes.UPDATE, str(database.filename), database.id)
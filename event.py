@@ -1,8 +1,11 @@
 "Event pages."
 
+import bisect
 import calendar
 import datetime as dt
+import heapq
 import math
+import re
 
 from fasthtml.common import *
 from fasthtml.pico import Card
@@ -10,6 +13,7 @@ import yaml
 
 import components
 import constants
+import errors
 import items
 import utils
 
@@ -106,26 +110,29 @@ def post(
 def get(event: items.Item, page: int = 1, tags_page: int = 1, refs_page: int = 1):
     "View the event."
     assert isinstance(event, items.Event)
+    # Occurrences of this event itself, if recurring, are excluded.
     subevents = set(
-        [e for e in items.get_items("event") if e.within(event.start, event.end)]
+        [
+            e
+            for e in items.get_events(event.start, event.end)
+            if e.within(event.start, event.end) and e.id != event.id
+        ]
     )
-    subevents.remove(event)
     subevents = sorted(subevents, key=lambda e: (len(e), e.start), reverse=True)
     superevents = set(
         [
             e
-            for e in items.get_items("event")
-            if e.overlap_days(event.start, event.endwh)
+            for e in items.get_events(event.start, event.endwh)
+            if e.overlap_days(event.start, event.endwh) and e.id != event.id
         ]
     )
-    superevents.remove(event)
     superevents = set(superevents).difference(subevents)
     superevents = sorted(superevents, key=lambda e: (len(e), e.start), reverse=True)
     return (
         Title(event),
         components.get_clipboard_script(),
         components.get_header_item_view(
-            event, operations=[A("Add recurring...", href=f"{event.url}/recurring")]
+            event, operations=[A("Recurring...", href=f"{event.url}/recurring")]
         ),
         Main(
             components.get_text_card(
@@ -160,6 +167,7 @@ def get(event: items.Item, page: int = 1, tags_page: int = 1, refs_page: int = 1
                     Div(
                         event.display(),
                         Span(event.duration, cls="lmargin"),
+                        Div(Small(event.recurring_display)) if event.recurring else "",
                         cls="center",
                     ),
                     Div(NotStr("&nbsp;"), style=event.background_style),
@@ -338,77 +346,50 @@ def post(
 
 @rt("/{event:Item}/recurring")
 def get(event: items.Item):
-    "Form for making recurring copies of the event."
+    "Form for setting the recurrence rule of the event."
     assert isinstance(event, items.Event)
+    rule = event.recurring or {}
+    if rule:
+        current = f"{rule['interval'] if rule['interval'] > 1 else ''}{rule['frequency']}"
+    else:
+        current = ""
+    choices = [
+        ("", "Not recurring"),
+        ("day", "Day"),
+        ("2day", "Two days"),
+        ("week", "Week"),
+        ("2week", "Two weeks"),
+        ("month", "Month"),
+        ("2month", "Two months"),
+        ("3month", "Three months"),
+        ("year", "Year"),
+    ]
+    fields = [Legend("Recurring every...")]
+    for value, label in choices:
+        fields.append(
+            Input(
+                type="radio",
+                id=f"recurring_{value or 'none'}",
+                name="recurring",
+                value=value,
+                checked=value == current,
+            )
+        )
+        fields.append(Label(label, htmlFor=f"recurring_{value or 'none'}"))
     return (
         Title(f"Recurring '{event}'"),
         Header(
             Nav(
                 Ul(
                     Li(components.get_nav_menu(event)),
-                    Li("Add recurring ", components.get_event_icon(), event),
+                    Li("Recurring ", components.get_event_icon(), event),
                 ),
             ),
             cls="container",
         ),
         Main(
             Form(
-                Fieldset(
-                    Legend("Recurring every..."),
-                    Input(
-                        type="radio", id="recurring_day", name="recurring", value="day"
-                    ),
-                    Label("Day", htmlFor="recurring_day"),
-                    Input(
-                        type="radio",
-                        id="recurring_2day",
-                        name="recurring",
-                        value="2day",
-                    ),
-                    Label("Two days", htmlFor="recurring_2day"),
-                    Input(
-                        type="radio",
-                        id="recurring_week",
-                        name="recurring",
-                        value="week",
-                    ),
-                    Label("Week", htmlFor="recurring_week"),
-                    Input(
-                        type="radio",
-                        id="recurring_2week",
-                        name="recurring",
-                        value="2week",
-                    ),
-                    Label("Two weeks", htmlFor="recurring_2week"),
-                    Input(
-                        type="radio",
-                        id="recurring_month",
-                        name="recurring",
-                        value="month",
-                    ),
-                    Label("Month", htmlFor="recurring_month"),
-                    Input(
-                        type="radio",
-                        id="recurring_2month",
-                        name="recurring",
-                        value="2month",
-                    ),
-                    Label("Two months", htmlFor="recurring_2month"),
-                    Input(
-                        type="radio",
-                        id="recurring_3month",
-                        name="recurring",
-                        value="3month",
-                    ),
-                    Label("Three months", htmlFor="recurring_3month"),
-                    Input(
-                        type="radio",
-                        id="recurring_year",
-                        name="recurring",
-                        value="year",
-                    ),
-                    Label("Year", htmlFor="recurring_year"),
-                ),
+                Fieldset(*fields),
                 Fieldset(
                     Label(
                         "After",
@@ -416,15 +397,32 @@ def get(event: items.Item):
                     ),
                     Label(
                         "Last day",
-                        Input(type="date", name="last_date"),
+                        Input(type="date", name="last_date", value=rule.get("until")),
                     ),
                     Label(
                         "Number of times",
-                        Input(type="number", name="number", min=1, step=1),
+                        Input(
+                            type="number",
+                            name="number",
+                            min=1,
+                            step=1,
+                            value=(rule["count"] - 1) if rule.get("count") else None,
+                        ),
                     ),
                     cls="grid",
                 ),
-                Input(type="submit", value="Add events"),
+                Label(
+                    "Except days",
+                    Input(
+                        type="text",
+                        name="exceptions",
+                        value=" ".join(
+                            [str(d) for d in rule.get("exceptions") or []]
+                        ),
+                        placeholder="YYYY-MM-DD ...",
+                    ),
+                ),
+                Input(type="submit", value="Save"),
                 action=f"{event.url}/recurring",
                 method="POST",
             ),
@@ -437,77 +435,35 @@ def get(event: items.Item):
 @rt("/{source:Item}/recurring")
 def post(
     session,
-    source: items.File,
+    source: items.Item,
     recurring: str = None,
     last_date: str = None,
     number: int = 0,
+    exceptions: str = "",
 ):
-    "Actually create and add the recurring events."
+    """Actually set the recurrence rule of the event.
+    The occurrences are not stored; they are computed when displayed.
+    """
     assert isinstance(source, items.Event)
-    number = number or None  # Zero means 'no value given'.
-    if last_date:
-        end = dt.datetime.combine(dt.date.fromisoformat(last_date), dt.time())
+    if recurring:
+        match = re.fullmatch(r"(\d*)(day|week|month|year)", recurring)
+        if not match:
+            raise errors.Error(f"invalid recurring value '{recurring}'")
+        try:
+            source.set_recurring(
+                frequency=match.group(2),
+                interval=int(match.group(1) or 1),
+                until=dt.date.fromisoformat(last_date) if last_date else None,
+                count=number + 1 if number else None,  # Including this event.
+                exceptions=[dt.date.fromisoformat(d) for d in exceptions.split()],
+            )
+        except ValueError as error:
+            raise errors.Error(error)
+        add_toast(session, f"{source.recurring_display}.", "success")
     else:
-        end = None
-    days = None
-    months = None
-    match recurring:
-        case "day":
-            days = dt.timedelta(days=1)
-        case "2day":
-            days = dt.timedelta(days=2)
-        case "week":
-            days = dt.timedelta(days=7)
-        case "2week":
-            days = dt.timedelta(days=14)
-        case "month":
-            months = 1
-        case "2month":
-            months = 2
-        case "3month":
-            months = 3
-        case "year":
-            months = 12
-        case _:
-            raise NotImplementedError
-
-    start = source.start
-    month = start.month
-    year = start.year
-    starts = []
-    while True:
-        if days:
-            start = start + days
-        else:
-            month += months
-            if month > 12:
-                month = month % 12
-                year += 1
-            day = source.start.day  # Original day used if possible.
-            while True:  # Watch out for shorter months.
-                try:
-                    start = dt.datetime(
-                        year, month, day, hour=start.hour, minute=start.minute
-                    )
-                except ValueError:  # No such day in that month and year.
-                    day -= 1
-                else:
-                    break
-        if end is not None and start > end:
-            break
-        if number is not None and (number := number - 1) < 0:
-            break
-        starts.append(start)
-
-    timedelta = source.end - source.start
-    for start in starts:
-        event = items.Event()
-        event.title = source.title
-        event.set(start, start + timedelta)
-        event.text = f"{source.text}\n\nRecurring copy of [[{source.id}]]."
-        event.tags = source.tags
-        event.write()
-    add_toast(session, f"Added {len(starts)} recurring events.", "success")
+        source.set_recurring()
+        add_toast(session, "Not recurring.", "success")
+    source.write()
     return components.redirect(source.url)
 
 
@@ -549,7 +505,7 @@ def get(year: int):
     "Display events during a specified year."
     start = dt.datetime(year, 1, 1)
     end = dt.datetime(year + 1, 1, 1)
-    events = [e for e in items.get_items("event") if e.overlap_days(start, end)]
+    events = [e for e in items.get_events(start, end) if e.overlap_days(start, end)]
     rows = []
     for month in [utils.get_datetime(year, m) for m in range(1, 13)]:
         rows.append(
@@ -648,7 +604,7 @@ def get(year: int, month: int):
     last = utils.to_datetime(days[-1][-1]) + dt.timedelta(days=1)
     start = utils.get_datetime(year, month)
     prev = first - dt.timedelta(days=1)
-    events = [e for e in items.get_items("event") if e.overlap(first, last)]
+    events = [e for e in items.get_events(first, last) if e.overlap(first, last)]
     title = f"{start.strftime('%B %Y').capitalize()}"
     return (
         Title(title),
@@ -735,7 +691,7 @@ def get(year: int, week: int):
         end = dt.datetime.strptime(f"{year+1}-{1}-1", "%G-%V-%u")
     prev = start - dt.timedelta(days=4)  # Thursday previous week.
     next = end + dt.timedelta(days=3)  # Thursday next week.
-    events = [e for e in items.get_items("event") if e.overlap(start, end)]
+    events = [e for e in items.get_events(start, end) if e.overlap(start, end)]
     weekdays = [start + dt.timedelta(days=day) for day in range(7)]
     thursday = weekdays[3]
     today_ordinal = dt.datetime.now().toordinal()
@@ -852,7 +808,7 @@ def get(year: int, month: int, day: int):
     next = thisday + dt.timedelta(days=1)
 
     # First events that extend over more than thisday, sorted by length.
-    events = [e for e in items.get_items("event") if e.overlap(thisday, next)]
+    events = [e for e in items.get_events(thisday, next) if e.overlap(thisday, next)]
     beyond_thisday = sorted(
         [e for e in events if not e.within(thisday, next)],
         key=lambda e: len(e),
@@ -1048,6 +1004,15 @@ def get_month_table(year, month, events, full=True, create=True):
     "Generate the display the given events of a specified month."
     today_ordinal = dt.datetime.now().toordinal()
     monthdays = list(calendar.Calendar().monthdatescalendar(year, month))
+    # Pack the events of the displayed days into lanes once for the whole month.
+    first = monthdays[0][0].toordinal()
+    last = monthdays[-1][-1].toordinal()
+    lanes = []
+    for lane in get_lanes(
+        [e for e in events if e.start.toordinal() <= last], span_days, first=first
+    ):
+        spans = [span_days(e) for e in lane]
+        lanes.append((lane, spans, [s[1] for s in spans]))
     rows = [
         Tr(
             Td(),
@@ -1089,22 +1054,25 @@ def get_month_table(year, month, events, full=True, create=True):
                 ],
             )
         )
-        first = utils.to_datetime(weekdays[0])
-        last = utils.to_datetime(weekdays[6]) + dt.timedelta(days=1)
         rows.extend(
             get_week_rows(
                 weekdays,
-                [e for e in events if e.overlap(first, last)],
+                None,
                 full=full,
                 create=create,
+                lanes=get_week_lanes(
+                    lanes, weekdays[0].toordinal(), weekdays[6].toordinal()
+                ),
             )
         )
         rows.append(Tr(Td(Div(cls="vspacer"), colspan=8)))
     return Table(*rows, cls="days")
 
 
-def get_week_rows(weekdays, events, offset=True, full=True, create=True):
-    "Return rows for the events of the week."
+def get_week_rows(weekdays, events, offset=True, full=True, create=True, lanes=None):
+    """Return rows for the events of the week.
+    If 'lanes' is given, use it instead of packing the events into lanes.
+    """
     weekdays = [utils.to_datetime(d) for d in weekdays]
     start = weekdays[0]
     end = weekdays[6] + dt.timedelta(days=1)
@@ -1124,13 +1092,12 @@ def get_week_rows(weekdays, events, offset=True, full=True, create=True):
         ]
     else:
         row_cells = []
-    events = set(events)
-    while events:
+    if lanes is None:
+        lanes = get_lanes(events, span_days)
+    for lane in lanes:
         cells = []
-        next_events = get_next_events_day(events, start, end)
-        events = set(events).difference(next_events)
         sum_colspan = 0
-        for event in next_events:
+        for event in lane:
             if event.start < start:
                 if event.endwh >= end:
                     colspan = 7
@@ -1188,11 +1155,8 @@ def get_vertical_display(start, end, events):
         ]
         for day in days
     ]
-    events = set(events)  # Make copy to avoid changing incoming argument.
-    while events:
-        next_events = get_next_events_day(events, start, end)
-        events = set(events).difference(next_events)
-        for event in next_events:
+    for lane in get_lanes(events, span_days):
+        for event in lane:
             for slot, day in enumerate(days):
                 if day.toordinal() == event.start.toordinal():
                     rows[slot].append(
@@ -1244,11 +1208,18 @@ def get_day_display(start, end, events):
         ]
         for hour in hours
     ]
-    while part_day_events:
+    # As before, the column with the largest overlap with the day comes first.
+    lanes = get_lanes(part_day_events, span_hours)
+    lanes.sort(
+        key=lambda lane: (
+            sum([e.overlap(start, end) for e in lane]),
+            sum([len(e) for e in lane]),
+        ),
+        reverse=True,
+    )
+    for lane in lanes:
         colspan += 1
-        next_events = get_next_events_hour(part_day_events, start, end)
-        part_day_events = set(part_day_events).difference(next_events)
-        for event in next_events:
+        for event in lane:
             for slot, hour in enumerate(hours):
                 if hour.hour == event.start.hour:
                     part_day_rows[slot].append(
@@ -1302,49 +1273,63 @@ def get_day_display(start, end, events):
     )
 
 
-def get_next_events_day(events, start, end):
-    "Return the next sorted list of non-overlapping events day-wise."
-    covers_period = [e for e in events if e.start <= start and e.end >= end]
-    if covers_period:
-        covers_period.sort()
-        return [covers_period[0]]
-    events = sorted(events)
-    result = []
-    for event in events:
-        for e in result:
-            if event.overlap_days(e.start, e.endwh):
-                break
+def get_lanes(events, span, first=None):
+    """Assign the events to lanes, such that events in a lane do not overlap.
+    The function 'span' gives the first and last units (inclusive) of an event.
+    Events ending before the unit 'first', if given, are skipped.
+    Sweep-line greedy colouring of the interval graph; O(n log n), and the
+    number of lanes is the minimum possible. Earlier and longer events are
+    placed first, in the lowest free lane.
+    Return the list of lanes, each a list of events sorted by start.
+    """
+    spans = [(*span(e), e) for e in events]
+    if first is not None:
+        spans = [s for s in spans if s[1] >= first]
+    spans.sort(key=lambda s: (s[0], -s[1], s[2].id))
+    lanes = []
+    active = []  # Heap of (last unit, lane number) for lanes currently in use.
+    free = []  # Heap of lane numbers that are free at the current unit.
+    for first, last, event in spans:
+        while active and active[0][0] < first:
+            heapq.heappush(free, heapq.heappop(active)[1])
+        if free:
+            lane = heapq.heappop(free)
         else:
-            result.append(event)
+            lane = len(lanes)
+            lanes.append([])
+        lanes[lane].append(event)
+        heapq.heappush(active, (last, lane))
+    return lanes
+
+
+def get_week_lanes(lanes, first, last):
+    """Return the parts of the lanes with events overlapping the days from
+    ordinal 'first' to 'last', inclusive; empty lanes are skipped.
+    Each item of 'lanes' is a tuple (events, spans, last days). Since the
+    events in a lane do not overlap, the last days are sorted.
+    """
+    result = []
+    for events, spans, lasts in lanes:
+        pos = bisect.bisect_left(lasts, first)
+        end = pos
+        while end < len(events) and spans[end][0] <= last:
+            end += 1
+        if end > pos:
+            result.append(events[pos:end])
     return result
 
 
-def get_next_events_hour(events, start, end):
-    "Return the next sorted list of non-overlapping events hour-wise."
-    non_overlapping = get_non_overlapping_hours(events)
-    non_overlapping.sort(
-        key=lambda s: (
-            sum([e.overlap(start, end) for e in s]),
-            sum([len(e) for e in s]),
-        ),
-        reverse=True,
-    )
-    return sorted(non_overlapping[0])
+def span_days(event):
+    "The first and last days of the event, as ordinals."
+    return (event.start.toordinal(), event.endwh.toordinal())
 
 
-def get_non_overlapping_hours(events, candidates=None):
-    "Return a list of of mutually hour-wise non-overlapping event lists."
-    events = sorted(events)
-    result = []
-    for pos, e in enumerate(events):
-        if candidates is None:
-            result.append([e])
-            result.extend(get_non_overlapping_hours(events[pos + 1 :], [e]))
-        elif not any([e.overlap_hours(c.start, c.end) for c in candidates]):
-            new_candidates = candidates + [e]
-            result.append(new_candidates)
-            result.extend(get_non_overlapping_hours(events[pos + 1 :], new_candidates))
-    return result
+def span_hours(event):
+    "The first and last hours of the event, counted from the ordinal of day one."
+    return (
+        24 * event.start.toordinal() + event.start.hour,
+        24 * event.endwh.toordinal() + event.endwh.hour,
+    )
 
 
 def get_event_display_minimal(event, start, end):
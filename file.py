@@ -90,12 +90,12 @@ def get(file: items.Item, page: int = 1, tags_page: int = 1, refs_page: int = 1)
 
 
 @rt("/{file:Item}{ext:Ext}")
-def get(file: items.Item, ext: str):
+def get(request, file: items.Item, ext: str):
     "Download the content of the file."
     assert isinstance(file, items.File)
     if file.filepath.suffix != ext:
         raise errors.Error("invalid format", HTTP.NOT_FOUND)
-    return FileResponse(file.filepath)
+    return components.get_file_response(request, file.filepath)
 
 
 @rt("/{file:Item}/edit")
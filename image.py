@@ -81,7 +81,7 @@ def get(image: items.Item, page: int = 1, tags_page: int = 1, refs_page: int = 1
         Main(
             Card(
                 A(
-                    Img(src=image.url_file, title=image.filename, cls="display"),
+                    components.get_image_img(image, title=image.filename),
                     href=image.url_file,
                 )
             ),
@@ -101,12 +101,23 @@ def get(image: items.Item, page: int = 1, tags_page: int = 1, refs_page: int = 1
 
 
 @rt("/{image:Item}{ext:Ext}")
-def get(image: items.Item, ext: str):
+def get(request, image: items.Item, ext: str):
     "Download the content of the image."
     assert isinstance(image, items.Image)
     if image.filepath.suffix != ext:
         raise errors.Error("invalid format", HTTP.NOT_FOUND)
-    return FileResponse(image.filepath)
+    return components.get_file_response(request, image.filepath)
+
+
+@rt("/thumbnail/{name:Name}{ext:Ext}")
+def get(request, name: str, ext: str):
+    "Return the down-scaled variant of an image; immutable, since keyed by hash."
+    if ext != constants.THUMBNAIL_EXT or set(name).difference("0123456789abcdef-"):
+        raise errors.Error("No such thumbnail", HTTP.NOT_FOUND)
+    path = constants.THUMBNAIL_DIR / f"{name}{ext}"
+    if not path.exists():
+        raise errors.Error("No such thumbnail", HTTP.NOT_FOUND)
+    return components.get_file_response(request, path, immutable=True)
 
 
 @rt("/{image:Item}/edit")
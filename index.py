@@ -0,0 +1,249 @@
+"Indexes of the items, maintained incrementally on write and delete."
+
+import bisect
+import datetime as dt
+import math
+
+import constants
+import utils
+
+# Key: item type; value: set of ids of items of that type.
+by_type = {}
+
+# Ordered indexes; sorted lists of tuples (key, item id).
+by_modified = []
+by_title = []
+# Key: item id; value: tuple (modified, title key) in the ordered indexes.
+item_keys = {}
+
+# Interval index of events. Key: duration class, such that the duration in
+# minutes is less than 2**class; value: list of (start, end, item id) sorted by start.
+by_interval = {}
+# Key: item id; value: tuple (duration class, start, end) in the interval index.
+item_interval = {}
+# Set of ids of events with a recurrence rule; these are not in the interval index.
+recurring = set()
+
+# Full-text inverted index. Key: term; value: {item id: (title count, text count)}.
+postings = {}
+# Sorted list of all terms in the full-text index; for prefix queries.
+vocabulary = []
+# Key: item id; value: set of terms for the item.
+item_terms = {}
+# Key: item id; value: weighted length of title and text, in terms.
+item_length = {}
+# Sum of the weighted lengths of all items; for the average length.
+total_length = 0
+
+# Incremented on every change to the indexes; for caches of data derived from items.
+generation = 0
+
+# Parameters for the BM25 ranking function.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(s):
+    "Return the list of terms in the string; folded as for filenames."
+    return [t for t in utils.normalize(s).split("-") if t]
+
+
+def clear():
+    "Remove all items from the indexes."
+    global total_length
+    global generation
+    generation += 1
+    by_type.clear()
+    by_modified.clear()
+    by_title.clear()
+    item_keys.clear()
+    by_interval.clear()
+    item_interval.clear()
+    recurring.clear()
+    postings.clear()
+    vocabulary.clear()
+    item_terms.clear()
+    item_length.clear()
+    total_length = 0
+
+
+def build(items):
+    "Set up the indexes from scratch for the given items."
+    clear()
+    for item in items:
+        add(item)
+
+
+def add(item):
+    "Add the item to the indexes, replacing any previous entries for it."
+    global total_length
+    global generation
+    remove(item)
+    generation += 1
+    by_type.setdefault(item.type, set()).add(item.id)
+    modified = item.stat()[0]
+    title = item.title.casefold()
+    item_keys[item.id] = (modified, title)
+    bisect.insort(by_modified, (modified, item.id))
+    bisect.insort(by_title, (title, item.id))
+    if item.type == "event" and item.recurring:
+        recurring.add(item.id)
+    elif item.type == "event" and not (item.start.tzinfo or item.end.tzinfo):
+        # An event with timezone is not yet migrated; it is added when it is.
+        duration_class = len(item).bit_length()
+        item_interval[item.id] = (duration_class, item.start, item.end)
+        intervals = by_interval.setdefault(duration_class, [])
+        bisect.insort(intervals, (item.start, item.end, item.id))
+    counts = {}
+    title_terms = tokenize(item.title)
+    text_terms = tokenize(item.text)
+    for term in title_terms:
+        counts[term] = (counts.get(term, (0, 0))[0] + 1, 0)
+    for term in text_terms:
+        title_count, text_count = counts.get(term, (0, 0))
+        counts[term] = (title_count, text_count + 1)
+    for term, count in counts.items():
+        try:
+            postings[term][item.id] = count
+        except KeyError:
+            postings[term] = {item.id: count}
+            bisect.insort(vocabulary, term)
+    item_terms[item.id] = set(counts)
+    length = constants.SCORE_TITLE_WEIGHT * len(title_terms) + len(text_terms)
+    item_length[item.id] = length
+    total_length += length
+
+
+def remove(item):
+    "Remove the item from the indexes, if present."
+    global total_length
+    global generation
+    generation += 1
+    by_type.get(item.type, set()).discard(item.id)
+    try:
+        modified, title = item_keys.pop(item.id)
+    except KeyError:
+        pass
+    else:
+        discard(by_modified, (modified, item.id))
+        discard(by_title, (title, item.id))
+    recurring.discard(item.id)
+    try:
+        duration_class, start, end = item_interval.pop(item.id)
+    except KeyError:
+        pass
+    else:
+        discard(by_interval[duration_class], (start, end, item.id))
+    for term in item_terms.pop(item.id, set()):
+        entries = postings[term]
+        entries.pop(item.id)
+        if not entries:
+            postings.pop(term)
+            vocabulary.pop(bisect.bisect_left(vocabulary, term))
+    total_length -= item_length.pop(item.id, 0)
+
+
+def discard(ordered, entry):
+    "Remove the entry from the ordered index, if present."
+    pos = bisect.bisect_left(ordered, entry)
+    if pos < len(ordered) and ordered[pos] == entry:
+        del ordered[pos]
+
+
+def update_modified(item):
+    "Update the entry for the item in the modified index, if indexed."
+    global generation
+    generation += 1
+    try:
+        modified, title = item_keys[item.id]
+    except KeyError:
+        return
+    discard(by_modified, (modified, item.id))
+    modified = item.stat()[0]
+    item_keys[item.id] = (modified, title)
+    bisect.insort(by_modified, (modified, item.id))
+
+
+def get_overlapping(start, end):
+    """Return the set of ids of events overlapping the period, limits included.
+    For each duration class, only events starting less than the maximum
+    duration of the class before the period can overlap it; those are
+    found by bisection.
+    """
+    result = set()
+    for duration_class, intervals in by_interval.items():
+        earliest = start - dt.timedelta(minutes=2**duration_class)
+        for pos in range(bisect.bisect_left(intervals, (earliest,)), len(intervals)):
+            event_start, event_end, id = intervals[pos]
+            if event_start > end:
+                break
+            if event_end >= start:
+                result.add(id)
+    return result
+
+
+class OrderedView:
+    """Sequence of the items in an ordered index.
+    Only the items actually accessed are looked up; a slice costs its length.
+    """
+
+    def __init__(self, ordered, get, reverse=False):
+        self.ordered = ordered
+        self.get = get
+        self.reverse = reverse
+
+    def __len__(self):
+        return len(self.ordered)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[pos] for pos in range(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if self.reverse:
+            key = len(self) - 1 - key
+        if key < 0:
+            raise IndexError(key)
+        return self.get(self.ordered[key][1])
+
+
+def expand(prefix):
+    "Return the terms in the full-text index starting with the given prefix."
+    start = bisect.bisect_left(vocabulary, prefix)
+    end = bisect.bisect_left(vocabulary, prefix + "\U0010ffff")
+    return vocabulary[start:end]
+
+
+def search(term):
+    """Return a dictionary {item id: score} for the items matching the term.
+    Each word in the term is a prefix that must match a word in the title
+    or text of the item. The score is BM25, with the title weighted heavier.
+    """
+    words = tokenize(term or "")
+    if not words or not item_length:
+        return {}
+    n_items = len(item_length)
+    average_length = total_length / n_items or 1
+    result = None
+    for word in words:
+        scores = {}
+        for match in expand(word):
+            entries = postings[match]
+            idf = math.log(1 + (n_items - len(entries) + 0.5) / (len(entries) + 0.5))
+            for id, (title_count, text_count) in entries.items():
+                if result is not None and id not in result:
+                    continue
+                frequency = constants.SCORE_TITLE_WEIGHT * title_count + text_count
+                norm = BM25_K1 * (
+                    1 - BM25_B + BM25_B * item_length[id] / average_length
+                )
+                scores[id] = scores.get(id, 0) + idf * frequency * (BM25_K1 + 1) / (
+                    frequency + norm
+                )
+        if result is None:
+            result = scores
+        else:
+            result = dict([(id, result[id] + s) for id, s in scores.items()])
+        if not result:
+            break
+    return result
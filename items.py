@@ -1,21 +1,27 @@
 "Item class, subclasses and helper functions."
 
+import atexit
 import contextlib
 import copy
 import datetime as dt
 import functools
+import itertools
 import mimetypes
 import os
 import pathlib
-import re
+import pickle
 import shutil
 import sqlite3
+import threading
+import time
 
 import filetype
 import yaml
 
+import changes
 import constants
 import errors
+import index
 import utils
 
 # Lookup of item types.
@@ -24,8 +30,22 @@ TYPES = {}
 # Global item lookup. Key: item id; value: item instance.
 lookup = {}
 
+# Version counter for items; a new value is assigned at each write.
+versions = itertools.count()
+
 # Global current state.
 state = dict(pinned=[], recent=[])
+state_lock = threading.RLock()
+# The write-behind timer for the state file, and the time of its first scheduling.
+state_flush = dict(timer=None, first=None)
+
+# Pointers between items; maintained incrementally on write and delete.
+# Key: tag id; value: set of ids of items using the tag.
+tagged = {}
+# Key: item id; value: set of ids of items referring to or including it.
+referred = {}
+# Key: item id; value: tuple (tag ids, referred ids) last recorded for the item.
+pointers = {}
 
 
 class Item:
@@ -40,7 +60,9 @@ class Item:
         self._path = path
         self.frontmatter = dict(type=self.__class__.__name__.lower())
         self.text = ""
-        self.refs_to_self = set()
+        # Key: path; value: tuple (mtime, size, time of stat).
+        self._stats = {}
+        self.version = next(versions)
 
     def __str__(self):
         return self.title
@@ -83,27 +105,50 @@ class Item:
             self._path = constants.DATA_DIR / f"{get_id(utils.normalize(title))}.md"
             lookup[self.id] = self
 
+    def stat(self, path=None, refresh=False):
+        """Return the tuple (mtime, size) for the Markdown file, or the given path.
+        The values are cached; the file is stat'ed only if not cached, if
+        'refresh' is set, or if the cached values are older than the
+        revalidation interval, when that is set.
+        """
+        path = path or self.path
+        now = time.monotonic()
+        try:
+            mtime, size, checked = self._stats[path]
+            if refresh:
+                raise KeyError
+            if constants.STAT_REVALIDATE and now - checked > constants.STAT_REVALIDATE:
+                raise KeyError
+        except KeyError:
+            stat = path.stat()
+            previous = self._stats.get(path)
+            mtime, size = stat.st_mtime, stat.st_size
+            self._stats[path] = (mtime, size, now)
+            if previous and previous[:2] != (mtime, size):
+                index.update_modified(self)
+        return (mtime, size)
+
     @property
     def size(self):
         "Size of the item Markdown file, in bytes."
-        return self.path.stat().st_size
+        return self.stat()[1]
 
     @property
     def modified(self):
         "Modified timestamp in ISO format in UTC timezone."
-        return utils.iso_utc_from_timestamp(self.path.stat().st_mtime)
+        return utils.iso_utc_from_timestamp(self.stat()[0])
 
     @property
     def modified_local(self):
         "Modified timestamp in ISO format in local timezone. Seconds not shown."
         return dt.datetime.fromtimestamp(
-            self.path.stat().st_mtime, tz=constants.TIMEZONE
+            self.stat()[0], tz=constants.TIMEZONE
         ).strftime("%Y-%m-%d %H:%M")
 
     @property
     def age(self):
         "String representation of age; hh:mm:ss if less than 1 day, else days."
-        age = dt.datetime.now() - dt.datetime.fromtimestamp(self.path.stat().st_mtime)
+        age = dt.datetime.now() - dt.datetime.fromtimestamp(self.stat()[0])
         hours, seconds = divmod(age.seconds, 3600)
         minutes, seconds = divmod(seconds, 60)
         if age.days > 0:
@@ -115,6 +160,18 @@ class Item:
     def tag_ids(self):
         return self.frontmatter.get("tags", set())
 
+    @property
+    def ref_ids(self):
+        "Set of ids of the items referred to or included in the text."
+        result = set([m.group(1) for m in constants.REF.finditer(self.text)])
+        result.update([m.group(1) for m in constants.INCL.finditer(self.text)])
+        return result
+
+    @property
+    def refs_to_self(self):
+        "Set of ids of the items referring to or including this item."
+        return referred.get(self.id, set())
+
     @property
     def tags(self):
         "Alphabetical list of tag items for the item."
@@ -125,7 +182,7 @@ class Item:
     @tags.setter
     def tags(self, tags):
         """Set the tags for the item, which are items or their identifiers.
-        No need to update '_tagged' elsewhere, since the 'write' will update it.
+        No need to update pointers elsewhere, since the 'write' will update them.
         """
         if tags:
             self.frontmatter["tags"] = set(
@@ -155,8 +212,11 @@ class Item:
 
     def write(self, refresh=True):
         """Write the item to file.
-        Setup pointers between items again; inefficient, but defensive and safe.
+        Update the pointers from this item to tags and referred items.
+        Update the indexes.
+        Record the change in the change log.
         """
+        operation = changes.UPDATE if self.path.exists() else changes.CREATE
         with self.path.open(mode="w") as outfile:
             if self.frontmatter:
                 frontmatter = copy.deepcopy(self.frontmatter)
@@ -170,37 +230,33 @@ class Item:
                 outfile.write("---\n")
             if self.text:
                 outfile.write(self.text)
+        self.version = next(versions)
+        self.stat(refresh=True)
+        index.add(self)
+        changes.record(operation, self.id)
         if refresh:
-            setup_pointers()
+            update_pointers(self)
+            if constants.VERIFY_POINTERS and (drift := verify_pointers()):
+                raise ValueError(f"pointers drifted for {', '.join(sorted(drift))}")
 
     def delete(self):
         """Delete the item from the file system; move to trash.
         Remove from the items lookup.
         Remove from pinned and recent, if present.
-        Setup pointers between items again; inefficient, but defensive and safe.
+        Remove the pointers from this item to tags and referred items.
+        Remove from the indexes.
+        Record the change in the change log.
         """
-        global lookup, state
+        global lookup
         shutil.move(self.path, constants.TRASH_DIR / self.id)
+        self._stats.clear()
         lookup.pop(self.id)
-        try:
-            state["pinned"].remove(self.id)
-        except ValueError:
-            pass
-        try:
-            state["recent"].remove(self.id)
-        except ValueError:
-            pass
-        write_state()
-        setup_pointers()
-
-    def score(self, term):
-        """Calculate the score for the term in the title or text of the item.
-        Presence in the title is weighted heavier.
-        """
-        rx = re.compile(f"{term.strip()}.*", re.IGNORECASE)
-        return constants.SCORE_TITLE_WEIGHT * len(rx.findall(self.title)) + len(
-            rx.findall(self.text)
-        )
+        write_state(remove=self)
+        update_pointers(self, remove=True)
+        index.remove(self)
+        changes.record(changes.DELETE, self.id)
+        if constants.VERIFY_POINTERS and (drift := verify_pointers()):
+            raise ValueError(f"pointers drifted for {', '.join(sorted(drift))}")
 
     @contextlib.contextmanager
     def patch(self):
@@ -212,6 +268,7 @@ class Item:
         finally:
             self.write(refresh=False)
             os.utime(self.path, times=utime)
+            self.stat(refresh=True)
 
 
 class Note(Item):
@@ -223,10 +280,6 @@ class Note(Item):
 class Tag(Item):
     "Tag item class."
 
-    def __init__(self, path=None):
-        super().__init__(path=path)
-        self._tagged = set()  # Set of id's of items using this tag.
-
     @property
     def color(self):
         return self.frontmatter.get("color")
@@ -238,6 +291,11 @@ class Tag(Item):
         else:
             self.frontmatter["color"] = None
 
+    @property
+    def _tagged(self):
+        "Set of id's of items using this tag."
+        return tagged.get(self.id, set())
+
     @property
     def tagged(self):
         "List of items tagged by this tag."
@@ -258,7 +316,11 @@ class Link(Item):
 
 @functools.total_ordering
 class Event(Item):
-    "Event item class; start and end datetimes."
+    "Event item class; start and end datetimes. Optionally a recurrence rule."
+
+    def __init__(self, path=None):
+        super().__init__(path=path)
+        self._occurrences = {}  # Cache; key: (version, start, end).
 
     def __str__(self):
         return f"{self.title} ({self.display(date=True)})"
@@ -435,6 +497,136 @@ class Event(Item):
         else:
             return f"background-image: linear-gradient(to right, {', '.join(colors)});"
 
+    @property
+    def recurring(self):
+        """The recurrence rule, if any; a dictionary with 'frequency', 'interval',
+        'until' (date), 'count' (total number) and 'exceptions' (list of dates).
+        """
+        return self.frontmatter.get("recurring")
+
+    def set_recurring(
+        self, frequency=None, interval=1, until=None, count=None, exceptions=None
+    ):
+        "Set the recurrence rule. Remove it if no frequency is given."
+        if not frequency:
+            self.frontmatter.pop("recurring", None)
+            return
+        if frequency not in constants.RECURRING_FREQUENCIES:
+            raise ValueError(f"invalid recurring frequency '{frequency}'")
+        if interval < 1:
+            raise ValueError("invalid recurring interval; must be >= 1")
+        self.frontmatter["recurring"] = dict(
+            frequency=frequency,
+            interval=interval,
+            until=until,
+            count=count,
+            exceptions=sorted(set(exceptions or [])),
+        )
+
+    @property
+    def recurring_display(self):
+        "Human-readable representation of the recurrence rule."
+        rule = self.recurring
+        if not rule:
+            return ""
+        if rule["interval"] == 1:
+            result = [f"Every {rule['frequency']}"]
+        else:
+            result = [f"Every {rule['interval']} {rule['frequency']}s"]
+        if rule.get("until"):
+            result.append(f"until {rule['until']}")
+        if rule.get("count"):
+            result.append(f"{rule['count']} times")
+        if rule.get("exceptions"):
+            result.append(f"except {', '.join([str(d) for d in rule['exceptions']])}")
+        return ", ".join(result)
+
+    def get_occurrence_starts(self, earliest):
+        """Generate the tuples (number, start) of the occurrences of the
+        recurring event, beginning with the first that may start at or
+        after 'earliest'. The first occurrence, number 0, is the event itself.
+        """
+        rule = self.recurring
+        count = rule.get("count")
+        until = rule.get("until")
+        if rule["frequency"] in ("day", "week"):
+            step = dt.timedelta(days=rule["interval"])
+            if rule["frequency"] == "week":
+                step *= 7
+            number = max(0, (earliest - self.start) // step)
+        else:
+            months = rule["interval"]
+            if rule["frequency"] == "year":
+                months *= 12
+            number = (
+                12 * (earliest.year - self.start.year)
+                + earliest.month
+                - self.start.month
+            )
+            number = max(0, number // months - 1)
+        while True:
+            if count is not None and number >= count:
+                return
+            if rule["frequency"] in ("day", "week"):
+                start = self.start + number * step
+            else:
+                year, month = divmod(self.start.month - 1 + number * months, 12)
+                year += self.start.year
+                day = self.start.day  # Original day used if possible.
+                while True:  # Watch out for shorter months.
+                    try:
+                        start = self.start.replace(year=year, month=month + 1, day=day)
+                    except ValueError:  # No such day in that month and year.
+                        day -= 1
+                    else:
+                        break
+            if until is not None and start.date() > until:
+                return
+            yield number, start
+            number += 1
+
+    def occurrences(self, start, end):
+        """Return the occurrences of the event overlapping the given start
+        and end datetimes, limits included. For an event without a recurrence
+        rule, only the event itself is considered. Other occurrences than the
+        first are copies with shifted start and end datetimes.
+        The result is computed on demand and cached per period.
+        """
+        if not self.recurring:
+            return [self] if self.start <= end and self.end >= start else []
+        key = (self.version, start, end)
+        try:
+            return self._occurrences[key]
+        except KeyError:
+            pass
+        if len(self._occurrences) >= constants.MAX_OCCURRENCES_CACHE:
+            self._occurrences.clear()
+        exceptions = set(self.recurring.get("exceptions") or [])
+        duration = self.end - self.start
+        result = []
+        for number, occurrence_start in self.get_occurrence_starts(start - duration):
+            if occurrence_start > end:
+                break
+            if occurrence_start + duration < start:
+                continue
+            if occurrence_start.date() in exceptions:
+                continue
+            if number == 0:
+                result.append(self)
+            else:
+                # The copy is not itself recurring, and has its own cache.
+                occurrence = copy.copy(self)
+                occurrence.frontmatter = dict(
+                    self.frontmatter,
+                    start=occurrence_start,
+                    end=occurrence_start + duration,
+                )
+                occurrence.frontmatter.pop("recurring", None)
+                occurrence._occurrences = {}
+                result.append(occurrence)
+        self._occurrences[key] = result
+        return result
+
     def within(self, start, end):
         "Is this event within the given start and end datetimes?"
         assert isinstance(start, dt.datetime)
@@ -603,11 +795,20 @@ class GenericFile(Item):
     @property
     def file_size(self):
         "Size of the file, in bytes."
-        return self.filepath.stat().st_size
+        return self.stat(self.filepath)[1]
 
     @property
     def mimetype(self):
         """Return MIME type, or None if not recognized.
+        Determined when the content is set, and recorded in the frontmatter.
+        """
+        try:
+            return self.frontmatter["mimetype"]
+        except KeyError:
+            return self.frontmatter.setdefault("mimetype", self.get_mimetype())
+
+    def get_mimetype(self):
+        """Determine the MIME type, or None if not recognized.
         Determined primarily from the file data, with the file extension as fall-back.
         """
         kind = filetype.guess(self.filepath)  # Reads the file; needs absolute filename.
@@ -622,7 +823,7 @@ class GenericFile(Item):
     @property
     def file_modified(self):
         "Modified timestamp in UTC ISO format."
-        return utils.iso_utc_from_timestamp(self.filepath.stat().st_mtime)
+        return utils.iso_utc_from_timestamp(self.stat(self.filepath)[0])
 
     @property
     def url_file(self):
@@ -636,14 +837,35 @@ class GenericFile(Item):
 
     @content.setter
     def content(self, data):
+        operation = changes.UPDATE if self.filepath.exists() else changes.CREATE
+        try:
+            self.filepath.write_bytes(data)
+        except OSError as error:
+            raise errors.Error(error)
+        self.stat(self.filepath, refresh=True)
+        self.frontmatter["mimetype"] = self.get_mimetype()
+        changes.record(operation, str(self.filename))
+
+    def move_content(self, path):
+        "Move the given file into place as the contents of the file."
+        operation = changes.UPDATE if self.filepath.exists() else changes.CREATE
         try:
-            return self.filepath.write_bytes(data)
+            os.replace(path, self.filepath)
         except OSError as error:
             raise errors.Error(error)
+        self.stat(self.filepath, refresh=True)
+        self.frontmatter["mimetype"] = self.get_mimetype()
+        changes.record(operation, str(self.filename))
+
+    def write(self, refresh=True):
+        "Write the item to file. The file content may also have changed."
+        self._stats.pop(self.filepath, None)
+        super().write(refresh=refresh)
 
     def delete(self):
         "Delete the item and file from the file system and remove from the lookup."
         shutil.move(self.filepath, constants.TRASH_DIR / self.filename)
+        changes.record(changes.DELETE, str(self.filename))
         super().delete()
 
 
@@ -662,11 +884,30 @@ class File(GenericFile):
 class Database(GenericFile):
     "Database (Sqlite3) item class."
 
-    def connect(self, readonly=False):
-        return _DatabaseConnection(self, readonly=readonly)
+    def __init__(self, path=None):
+        super().__init__(path=path)
+        self._schema = None  # Cache; tuple (mtime_ns, size, schema).
+
+    def connect(self, readonly=False, threaded=False):
+        """Return a context manager for a connection to the database.
+        If 'threaded', the connection may be used from different threads,
+        but only one at a time; e.g. from a generator of a streaming response.
+        """
+        return _DatabaseConnection(self, readonly=readonly, threaded=threaded)
 
     def get_schema(self):
-        "Return the definitions of tables and views in the database."
+        """Return the definitions of tables and views in the database.
+        The result is cached until the database file changes, or a connection
+        for writing to it is closed. Do not modify the result.
+        """
+        stat = self.filepath.stat()
+        key = (stat.st_mtime_ns, stat.st_size)
+        if self._schema is not None and self._schema[:2] == key:
+            return self._schema[2]
+        estimate = (
+            constants.DATABASE_ESTIMATE_SIZE
+            and stat.st_size > constants.DATABASE_ESTIMATE_SIZE
+        )
         result = {}
         with self.connect(readonly=True) as cnx:
             names = []
@@ -690,12 +931,35 @@ class Database(GenericFile):
                 ).fetchone()[0]
                 relation["sql"] = sql
                 relation["type"] = sql.split()[1].lower()
-                relation["count"] = cnx.execute(
-                    f"SELECT COUNT(*) FROM {name}"
-                ).fetchone()[0]
+                relation["count"] = None
+                if estimate and relation["type"] == "table":
+                    relation["count"] = self.get_count_estimate(cnx, name)
+                relation["estimated"] = relation["count"] is not None
+                if relation["count"] is None:
+                    relation["count"] = cnx.execute(
+                        f"SELECT COUNT(*) FROM {name}"
+                    ).fetchone()[0]
                 result[name] = relation
+        self._schema = (*key, result)
         return result
 
+    def get_count_estimate(self, cnx, name):
+        """Return an estimate of the number of rows in the table, or None.
+        From the statistics of ANALYZE, if any, otherwise the maximum rowid.
+        """
+        try:
+            row = cnx.execute(
+                "SELECT stat FROM sqlite_stat1 WHERE tbl=?", (name,)
+            ).fetchone()
+            if row:
+                return int(row[0].split()[0])
+        except sqlite3.OperationalError:  # No statistics in the database.
+            pass
+        try:
+            return cnx.execute(f"SELECT MAX(rowid) FROM {name}").fetchone()[0] or 0
+        except sqlite3.OperationalError:  # Table without rowid.
+            return None
+
     @property
     def url_sql(self):
         "Return the URL to download the database as SQL."
@@ -704,17 +968,22 @@ class Database(GenericFile):
 
 class _DatabaseConnection:
 
-    def __init__(self, database, readonly=False):
+    def __init__(self, database, readonly=False, threaded=False):
         self.database = database
         self.readonly = readonly
+        self.threaded = threaded
 
     def __enter__(self):
         if self.readonly:
             self.cnx = sqlite3.connect(
-                f"file:{self.database.filepath}?mode=ro", uri=True
+                f"file:{self.database.filepath}?mode=ro",
+                uri=True,
+                check_same_thread=not self.threaded,
             )
         else:
-            self.cnx = sqlite3.connect(self.database.filepath)
+            self.cnx = sqlite3.connect(
+                self.database.filepath, check_same_thread=not self.threaded
+            )
         return self.cnx
 
     def __exit__(self, etyp, einst, etb):
@@ -723,6 +992,8 @@ class _DatabaseConnection:
         else:
             self.cnx.rollback()
         self.cnx.close()
+        if not self.readonly:
+            self.database._schema = None
 
 
 class Graphic(Item):
@@ -895,26 +1166,76 @@ def get(itemid):
     return lookup[itemid]
 
 
-def write_state(recent=None, pin=None, unpin=None):
+def write_state(recent=None, pin=None, unpin=None, remove=None):
+    """Update the state in memory. If changed, schedule it to be written
+    to file by the write-behind timer; many updates are coalesced into one write.
+    """
     global state
-    if recent is not None:
-        try:
-            state["recent"].remove(recent.id)
-        except ValueError:
-            pass
-        state["recent"].insert(0, recent.id)
-    if pin is not None:
-        if pin.id not in state["pinned"]:
-            state["pinned"].append(pin.id)
-    if unpin is not None:
-        try:
-            state["pinned"].remove(unpin.id)
-        except ValueError:
-            pass
-    cleanup_state()
-    while len(state["recent"]) > constants.MAX_RECENT_ITEMS + len(state["pinned"]) + 1:
-        state["recent"].pop()
-    constants.STATE_FILE.write_text(yaml.safe_dump(state, allow_unicode=True))
+    with state_lock:
+        before = copy.deepcopy(state)
+        if recent is not None:
+            try:
+                state["recent"].remove(recent.id)
+            except ValueError:
+                pass
+            state["recent"].insert(0, recent.id)
+        if pin is not None:
+            if pin.id not in state["pinned"]:
+                state["pinned"].append(pin.id)
+        if unpin is not None:
+            try:
+                state["pinned"].remove(unpin.id)
+            except ValueError:
+                pass
+        if remove is not None:
+            for key in ("pinned", "recent"):
+                try:
+                    state[key].remove(remove.id)
+                except ValueError:
+                    pass
+        cleanup_state()
+        while (
+            len(state["recent"]) > constants.MAX_RECENT_ITEMS + len(state["pinned"]) + 1
+        ):
+            state["recent"].pop()
+        if state != before:
+            schedule_flush_state()
+
+
+def schedule_flush_state():
+    """Schedule writing the state to file. Each call postpones the write by
+    STATE_FLUSH_DELAY seconds, but not beyond STATE_FLUSH_MAX_DELAY seconds
+    after the first call since the last write.
+    """
+    global state_flush
+    with state_lock:
+        now = time.monotonic()
+        if state_flush["timer"] is None:
+            state_flush["first"] = now
+        else:
+            state_flush["timer"].cancel()
+        delay = min(
+            constants.STATE_FLUSH_DELAY,
+            state_flush["first"] + constants.STATE_FLUSH_MAX_DELAY - now,
+        )
+        state_flush["timer"] = threading.Timer(max(0, delay), flush_state)
+        state_flush["timer"].daemon = True
+        state_flush["timer"].start()
+
+
+@atexit.register
+def flush_state():
+    "Write the state to file atomically, if there are pending changes."
+    global state_flush
+    with state_lock:
+        if state_flush["timer"] is None:
+            return
+        state_flush["timer"].cancel()
+        state_flush["timer"] = None
+        content = yaml.safe_dump(state, allow_unicode=True)
+        tmppath = constants.STATE_FILE.with_suffix(".tmp")
+        tmppath.write_text(content)
+        os.replace(tmppath, constants.STATE_FILE)
 
 
 def cleanup_state():
@@ -929,9 +1250,11 @@ def get_shortcuts(item=None):
     If item is provided, update the recent items.
     """
     global lookup, state
-    recent = list(state["recent"])
+    with state_lock:
+        recent = list(state["recent"])
     if item is None:
-        cleanup_state()
+        with state_lock:
+            cleanup_state()
     else:
         try:
             recent.remove(item.id)
@@ -947,7 +1270,8 @@ def read(data_dir=constants.DATA_DIR):
     """Read all items from Markdowwn files in the data directory.
     Create the data directory if it does not exist.
     Read the current state; recent and pinned items.
-    Set up pointers between items.
+    Use the snapshot for files unchanged since it was written; parse the others.
+    Set up pointers between items and the indexes.
     """
     global lookup, state
     try:
@@ -955,60 +1279,160 @@ def read(data_dir=constants.DATA_DIR):
         state.update(yaml.safe_load(constants.STATE_FILE.read_text()))
     except IOError:
         state = dict(pinned=[], recent=[])
-        write_state()
+        schedule_flush_state()
+        flush_state()
     lookup.clear()
+    snapshot = read_snapshot(data_dir)
+    entries = {}
+    changed = False
     for path in data_dir.iterdir():
-        item = read_item(path)
-        if item is not None:
+        if path.suffix != ".md":
+            continue
+        stat = path.stat()
+        try:
+            entry = snapshot[path.name]
+            if entry[:2] != (stat.st_mtime_ns, stat.st_size):
+                raise KeyError
+        except KeyError:
+            entry = (stat.st_mtime_ns, stat.st_size, *parse_item(path))
+            changed = True
+        entries[path.name] = entry
+        if entry[2] is not None:
+            item = get_item(path, entry[2], entry[3])
+            item._stats[path] = (stat.st_mtime, stat.st_size, time.monotonic())
             lookup[item.id] = item
+    if changed or len(entries) != len(snapshot):
+        write_snapshot(data_dir, entries)
     setup_pointers()
+    index.build(lookup.values())
 
 
-def read_item(path):
-    "Read the Markdown file and return the item."
-    if path.suffix != ".md":
-        return None
+def parse_item(path):
+    """Parse the Markdown file and return the tuple (frontmatter, text).
+    The frontmatter is None if the file does not contain any.
+    """
     content = path.read_text()
     m = constants.FRONTMATTER.match(content)
     if not m:
-        return None
+        return (None, None)
     frontmatter = yaml.safe_load(m.group(1))
     # Convert tags from YAML list to set.
     try:
         frontmatter["tags"] = set(frontmatter["tags"])
     except KeyError:
         pass
+    return (frontmatter, content[m.start(2) :])
+
+
+def get_item(path, frontmatter, text):
+    "Create the item from its parsed frontmatter and text."
     item = TYPES[frontmatter["type"]](path)
-    item.frontmatter.update(frontmatter)
-    item.text = content[m.start(2) :]
+    item.frontmatter.update(copy.deepcopy(frontmatter))
+    item.text = text
     return item
 
 
+def read_snapshot(data_dir=constants.DATA_DIR):
+    """Read the snapshot of parsed Markdown files in the data directory.
+    Return a dictionary with key: filename; value: (mtime_ns, size, frontmatter, text).
+    Return an empty dictionary if the snapshot is missing, corrupt or outdated.
+    """
+    try:
+        with (data_dir / constants.SNAPSHOT_FILE.name).open("rb") as infile:
+            snapshot = pickle.load(infile)
+        if snapshot["format"] != constants.SNAPSHOT_FORMAT:
+            return {}
+        if snapshot["version"] != constants.__version__:
+            return {}
+        return snapshot["entries"]
+    except (
+        OSError,
+        EOFError,
+        pickle.UnpicklingError,
+        AttributeError,
+        ImportError,
+        IndexError,
+        KeyError,
+        TypeError,
+        ValueError,
+    ):
+        return {}
+
+
+def write_snapshot(data_dir, entries):
+    "Write the snapshot of parsed Markdown files atomically; replace any old one."
+    path = data_dir / constants.SNAPSHOT_FILE.name
+    tmppath = path.with_suffix(".tmp")
+    try:
+        with tmppath.open("wb") as outfile:
+            pickle.dump(
+                dict(
+                    format=constants.SNAPSHOT_FORMAT,
+                    version=constants.__version__,
+                    entries=entries,
+                ),
+                outfile,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(tmppath, path)
+    except OSError:  # Not fatal; the next startup just reads all files.
+        tmppath.unlink(missing_ok=True)
+
+
 def setup_pointers():
-    """For each tag item, record in '_tagged' those items using it.
-    Set the 'refs_to_self' for item references."
+    """Set up all pointers between items from scratch.
+    For each tag, record those items using it.
+    For each item, record those items referring to or including it.
     """
+    global tagged, referred, pointers
+    tagged.clear()
+    referred.clear()
+    pointers.clear()
     for item in lookup.values():
-        if isinstance(item, Tag):
-            item._tagged.clear()
-        item.refs_to_self.clear()
-    for item in lookup.values():
-        for tag in item.tags:
-            tag._tagged.add(item.id)
-        for m in constants.REF.finditer(item.text):
-            try:
-                other = get(m.group(1))
-            except KeyError:
-                pass
-            else:
-                other.refs_to_self.add(item.id)
-        for m in constants.INCL.finditer(item.text):
-            try:
-                other = get(m.group(1))
-            except KeyError:
-                pass
-            else:
-                other.refs_to_self.add(item.id)
+        update_pointers(item)
+
+
+def update_pointers(item, remove=False):
+    """Update the pointers from the item to its tags and referred items.
+    Only the difference from the previously recorded pointers is applied.
+    If 'remove' is set, remove all pointers from the item.
+    """
+    global tagged, referred, pointers
+    old_tag_ids, old_ref_ids = pointers.pop(item.id, (frozenset(), frozenset()))
+    if remove:
+        tag_ids = ref_ids = frozenset()
+    else:
+        tag_ids = frozenset(item.tag_ids)
+        ref_ids = frozenset(item.ref_ids)
+        pointers[item.id] = (tag_ids, ref_ids)
+    for target, old_ids, new_ids in [
+        (tagged, old_tag_ids, tag_ids),
+        (referred, old_ref_ids, ref_ids),
+    ]:
+        for id in old_ids.difference(new_ids):
+            ids = target[id]
+            ids.discard(item.id)
+            if not ids:
+                target.pop(id)
+        for id in new_ids.difference(old_ids):
+            target.setdefault(id, set()).add(item.id)
+
+
+def verify_pointers():
+    """Check the incrementally maintained pointers against a full rebuild.
+    Return the set of ids of items or tags for which they differ.
+    The full rebuild is kept, so any drift is repaired.
+    """
+    global tagged, referred
+    old_tagged = copy.deepcopy(tagged)
+    old_referred = copy.deepcopy(referred)
+    setup_pointers()
+    result = set()
+    for old, new in [(old_tagged, tagged), (old_referred, referred)]:
+        for id in set(old).union(new):
+            if old.get(id) != new.get(id):
+                result.add(id)
+    return result
 
 
 def get_items(type=None):
@@ -1017,26 +1441,44 @@ def get_items(type=None):
     if type is None:
         return list(lookup.values())
     else:
-        type = type.lower()
-        return [i for i in lookup.values() if i.type == type]
+        return [lookup[id] for id in index.by_type.get(type.lower(), set())]
 
 
-def get_all_files():
-    "Get a map of item paths and filepaths with their 'modified' and 'size' values."
-    global lookup
-    result = {
-        constants.STATE_FILE.name: utils.iso_utc_from_timestamp(
-            constants.STATE_FILE.stat().st_mtime
+def get_items_ordered(key="modified", reverse=False, ids=None):
+    """Get all items, or those with the given ids, ordered by 'modified' or 'title'.
+    For all items, return a sequence view of the ordered index; slicing a
+    page from it costs only the page size.
+    """
+    pos = ["modified", "title"].index(key)
+    if ids is None:
+        ordered = index.by_modified if pos == 0 else index.by_title
+        return index.OrderedView(ordered, get, reverse=reverse)
+    else:
+        ids = sorted(
+            ids, key=lambda id: (index.item_keys[id][pos], id), reverse=reverse
         )
-    }
-    result = {}
-    for item in lookup.values():
-        result[item.id] = dict(modified=item.modified, size=item.size)
-        if isinstance(item, GenericFile):
-            if item.filename.exists():  # Due to previous bug, the file may not exist.
-                result[str(item.filename)] = dict(
-                    modified=item.file_modified, size=item.file_size
-                )
+        return [lookup[id] for id in ids]
+
+
+def get_events(start, end):
+    """Get the events that may overlap the days of the period, using the
+    interval index. The period is widened by one day at each end; the caller
+    must apply the exact criterion. Recurring events are expanded into
+    their occurrences in the period.
+    """
+    day = dt.timedelta(days=1)
+    result = [lookup[id] for id in index.get_overlapping(start - day, end + day)]
+    for id in index.recurring:
+        result.extend(lookup[id].occurrences(start - day, end + day))
+    return result
+
+
+def get_tagged_ids(tag_ids):
+    "Get the set of ids of items having any of the given tags."
+    global tagged
+    result = set()
+    for id in tag_ids:
+        result.update(tagged.get(id, set()))
     return result
 
 
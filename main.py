@@ -2,6 +2,7 @@
 databases, graphics, books and articles.
 """
 
+from http import HTTPStatus as HTTP
 import itertools
 import os
 import pathlib
@@ -25,8 +26,12 @@ if os.environ.get("CHAOS_DEVELOPMENT"):
 
 import constants
 import bibtex
+import changes
 import components
+import index
 import items
+import manifest
+import thumbnails
 import note
 import tag
 import link
@@ -58,17 +63,23 @@ app, rt = components.get_app_rt(
 )
 
 constants.TRASH_DIR.mkdir(exist_ok=True)
+constants.UPLOAD_DIR.mkdir(exist_ok=True)
 
-migrate()
+changes.read()
 
 items.read()
 
+migrate()
+
+manifest.start()
+
+thumbnails.start()
+
 
 @rt("/")
 def get(page: int = 1):
-    "Display all items; paged."
-    result = items.get_items()
-    result.sort(key=lambda i: i.modified, reverse=True)
+    "Display all items; paged. Only the items in the page are looked up."
+    result = items.get_items_ordered("modified", reverse=True)
     title = "chaos"
     return (
         Title(title),
@@ -210,61 +221,43 @@ def get(
     page: int = 1,
 ):
     "Search among the items."
-    # Filter by item type.
+    # Filter by item type and tags; set intersection of the indexes.
+    candidates = None
     if type in items.TYPES:
-        # Filter by tags.
-        if tags:
-            candidates = (
-                i
-                for i in items.lookup.values()
-                if i.type == type and i.tag_ids.intersection(tags)
-            )
+        candidates = set(index.by_type.get(type, set()))
+    if tags:
+        tagged = items.get_tagged_ids(tags)
+        if candidates is None:
+            candidates = tagged
         else:
-            candidates = (i for i in items.lookup.values() if i.type == type)
+            candidates.intersection_update(tagged)
 
-    # Filter by tags.
-    elif tags:
-        candidates = (i for i in items.lookup.values() if i.tag_ids.intersection(tags))
-    # No filter.
-    else:
-        candidates = None
-
-    result = []
-    # Search by term.
+    # Search by term using the full-text index; restrict to the filtered items.
     if term:
-        if candidates is None:
-            candidates = items.lookup.values()
-        for item in candidates:
-            if score := item.score(term):
-                item._score = score
-                result.append(item)
-
+        scores = index.search(term)
+        if candidates is not None:
+            scores = dict([(id, scores[id]) for id in candidates.intersection(scores)])
     # No term; all filtered items.
     elif candidates is not None:
-        result = list(candidates)
-        for item in result:
-            item._score = 0
+        scores = dict.fromkeys(candidates, 0)
+    else:
+        scores = {}
 
-    # Sort the resulting items.
+    # Sort the resulting items; using the ordered indexes.
     match order:
-        case "term_desc":
-            if term:
-                result.sort(key=lambda i: (i._score, i.modified), reverse=True)
-            else:
-                result.sort(key=lambda i: item.modified, reverse=True)
         case "age_asc":
-            result.sort(key=lambda i: i.modified, reverse=True)
+            result = items.get_items_ordered("modified", reverse=True, ids=scores)
         case "age_desc":
-            result.sort(key=lambda i: i.modified)
+            result = items.get_items_ordered("modified", ids=scores)
         case "lex_asc":
-            result.sort(key=lambda i: i.title.casefold())
+            result = items.get_items_ordered("title", ids=scores)
         case "lex_desc":
-            result.sort(key=lambda i: i.title.casefold(), reverse=True)
+            result = items.get_items_ordered("title", reverse=True, ids=scores)
         case _:
+            result = items.get_items_ordered("modified", reverse=True, ids=scores)
+            # Stable sort; items with equal score remain ordered by modified.
             if term:
-                result.sort(key=lambda i: (i._score, i.modified), reverse=True)
-            else:
-                result.sort(key=lambda i: i.modified, reverse=True)
+                result.sort(key=lambda i: scores[i.id], reverse=True)
 
     return (
         Title("Search"),
@@ -441,8 +434,16 @@ def get(item: items.Item):
 
 
 @rt("/source/{item:Item}")
-def get(item: items.Item):
-    return Response(content=item.path.read_text(), media_type=constants.TEXT_MIMETYPE)
+def get(request, item: items.Item):
+    "Return the Markdown source of the item, unless the client has the current one."
+    headers = components.get_validators(item.path)
+    if components.is_not_modified(request, headers):
+        return Response(status_code=HTTP.NOT_MODIFIED, headers=headers)
+    return Response(
+        content=item.path.read_text(),
+        media_type=constants.TEXT_MIMETYPE,
+        headers=headers,
+    )
 
 
 @rt("/status")
@@ -674,10 +675,12 @@ def post(names: list[str] = None):
         path = constants.TRASH_DIR / name
         itemid = items.get_id(name)
         shutil.move(path, constants.DATA_DIR / f"{itemid}.md")
+        changes.record(changes.RESTORE, itemid)
         if filepaths := list(constants.TRASH_DIR.glob(f"{name}.*")):
             source = filepaths[0]
             target = constants.DATA_DIR / filepaths[0].with_stem(itemid).name
             shutil.move(source, target)
+            changes.record(changes.RESTORE, target.name)
     items.read()
     return components.redirect("/status/trash")
 
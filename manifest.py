@@ -0,0 +1,178 @@
+"""Manifest of all files, with content hashes; for syncing to a local copy.
+The hashes are computed in a background thread, and are valid as long as
+the modified time and size of the file are unchanged. They are saved to
+a file, so that they need not be recomputed after a restart.
+"""
+
+import atexit
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+
+import constants
+import index
+import items
+import utils
+
+# Key: file path; value: tuple (mtime, size, hex digest of content).
+hashes = {}
+# Paths of files waiting to be hashed.
+pending = set()
+pending_queue = queue.Queue()
+pending_lock = threading.Lock()
+# Incremented whenever a hash has been computed.
+hashes_generation = 0
+# Hashes generation when the hashes were last written to file.
+written_generation = 0
+
+# Tuple (index generation, hashes generation, ETag, manifest), or None.
+current = None
+# Monotonic time when the stats of the files were last revalidated.
+revalidated = 0
+
+
+def compute_hash(path):
+    "Return the hex digest of the content of the file."
+    digest = hashlib.sha256()
+    with path.open("rb") as infile:
+        while chunk := infile.read(constants.DOWNLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_hash(path, mtime, size, request=True):
+    """Return the hash of the content of the file, if computed for the given
+    modified time and size. Otherwise request it, if so specified, and return None.
+    """
+    try:
+        hash_mtime, hash_size, digest = hashes[path]
+        if (hash_mtime, hash_size) == (mtime, size):
+            return digest
+    except KeyError:
+        pass
+    if not request:
+        return None
+    with pending_lock:
+        if path not in pending:
+            pending.add(path)
+            pending_queue.put(path)
+    return None
+
+
+def set_hash(path, digest):
+    "Set the hash of the content of the file, when computed elsewhere."
+    global hashes_generation
+    stat = path.stat()
+    hashes[path] = (stat.st_mtime, stat.st_size, digest)
+    with pending_lock:
+        hashes_generation += 1
+
+
+def worker():
+    """Compute the hashes of the files in the queue, one at a time.
+    Write the hashes to file when the queue has been emptied.
+    """
+    global hashes_generation
+    while True:
+        path = pending_queue.get()
+        try:
+            stat = path.stat()
+            hashes[path] = (stat.st_mtime, stat.st_size, compute_hash(path))
+        except OSError:
+            pass
+        with pending_lock:
+            pending.discard(path)
+            hashes_generation += 1
+            done = not pending
+        if done:
+            write_hashes()
+
+
+def read_hashes():
+    "Read the hashes from file; keep only those for the current files."
+    try:
+        with constants.HASHES_FILE.open() as infile:
+            data = json.load(infile)
+    except (OSError, ValueError):
+        return
+    paths = set([path for name, path, mtime, size in get_files()])
+    for name, (mtime, size, digest) in data.items():
+        path = constants.DATA_DIR / name
+        if path in paths:
+            hashes[path] = (mtime, size, digest)
+
+
+@atexit.register
+def write_hashes():
+    "Write the hashes to file atomically, if any have been computed since last time."
+    global written_generation
+    generation = hashes_generation
+    if generation == written_generation:
+        return
+    data = {}
+    for path, entry in list(hashes.items()):
+        data[str(path.relative_to(constants.DATA_DIR))] = entry
+    tmppath = constants.HASHES_FILE.with_suffix(".tmp")
+    try:
+        with tmppath.open("w") as outfile:
+            json.dump(data, outfile)
+        os.replace(tmppath, constants.HASHES_FILE)
+        written_generation = generation
+    except OSError:  # Not fatal; the hashes are recomputed after restart.
+        tmppath.unlink(missing_ok=True)
+
+
+def start():
+    """Read the saved hashes, start the background thread, and request
+    the hashes of all files not already known.
+    """
+    read_hashes()
+    threading.Thread(target=worker, daemon=True).start()
+    get()
+
+
+def get_files():
+    "Return a list of tuples (name, path, mtime, size) for all files of all items."
+    result = []
+    for item in list(items.lookup.values()):
+        try:
+            result.append((item.id, item.path, *item.stat()))
+            if isinstance(item, items.GenericFile):
+                filepath = item.filepath
+                result.append((str(item.filename), filepath, *item.stat(filepath)))
+        except FileNotFoundError:  # Due to previous bug, the file may not exist.
+            pass
+    return result
+
+
+def get():
+    """Return the tuple (ETag, manifest); the manifest is a dictionary
+    {name: {modified, size, hash}} for all files of all items. The hash
+    is None if not yet computed. The manifest is recomputed only when
+    an item has changed or a hash has been computed. If the stats of the
+    files are to be revalidated, that is done at most once per interval;
+    a changed file updates the index generation.
+    """
+    global current, revalidated
+    files = None
+    now = time.monotonic()
+    if constants.STAT_REVALIDATE and now - revalidated > constants.STAT_REVALIDATE:
+        files = get_files()
+        revalidated = now
+    generations = (index.generation, hashes_generation)
+    if current is not None and current[:2] == generations:
+        return current[2:]
+    manifest = {}
+    for name, path, mtime, size in files or get_files():
+        manifest[name] = dict(
+            modified=utils.iso_utc_from_timestamp(mtime),
+            size=size,
+            hash=get_hash(path, mtime, size),
+        )
+    etag = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+    etag = f'"{etag[:32]}"'
+    current = (*generations, etag, manifest)
+    return current[2:]
@@ -1,4 +1,7 @@
-"Extension to Markdown; ref."
+"Extension to Markdown; ref. Cache of rendered HTML."
+
+import collections
+import threading
 
 import marko
 import marko.inline
@@ -8,6 +11,14 @@ import components
 import constants
 import items
 
+# Converter instances are not thread-safe; one per thread is reused.
+_local = threading.local()
+
+# LRU cache of rendered HTML. Key: item id; value: (version, dependencies, html).
+_cache = collections.OrderedDict()
+_cache_size = 0
+_cache_lock = threading.Lock()
+
 
 class Url(marko.inline.InlineElement):
     "Extension to make a bare URL into a link."
@@ -94,6 +105,11 @@ class Incl(marko.inline.InlineElement):
 class InclRenderer:
     "Include the content of the item."
 
+    def __enter__(self):
+        "Reset the count of Vega-Lite graphics for each render."
+        self._vega_lite_ordinal = 0
+        return super().__enter__()
+
     def render_incl(self, element):
         try:
             item = items.get(element.incl)
@@ -117,12 +133,10 @@ class InclRenderer:
 
                     case "Vega-Lite":
                         result = []
-                        try:
-                            self._vega_lite_ordinal += 1
-                            ordinal = self._vega_lite_ordinal
-                        except AttributeError:
-                            ordinal = self._vega_lite_ordinal = 1
-                            # Add Vega-Lite libraries only for the first instance.
+                        self._vega_lite_ordinal += 1
+                        ordinal = self._vega_lite_ordinal
+                        # Add Vega-Lite libraries only for the first instance.
+                        if ordinal == 1:
                             result.extend(
                                 [
                                     f'<script src="{lib}"></script>'
@@ -148,22 +162,70 @@ vegaEmbed("#chaos_graphic{ordinal}", specification, {{downloadFileName: "filenam
         return f'<span class="error">Error: invalid type [!{item.id}]]</span>'
 
 
+def get_converter():
+    "Get the converter instance for the current thread; create it if necessary."
+    try:
+        return _local.converter
+    except AttributeError:
+        _local.converter = marko.Markdown(
+            extensions=[
+                marko.helpers.MarkoExtension(
+                    elements=[Url, Email, Tel, Ref, Incl],
+                    renderer_mixins=[
+                        UrlRenderer,
+                        EmailRenderer,
+                        TelRenderer,
+                        RefRenderer,
+                        InclRenderer,
+                    ],
+                )
+            ]
+        )
+        return _local.converter
+
+
 def to_html(text):
-    "Use a fresh converter instance for each invocation."
+    "Convert the text to HTML using the converter instance for the current thread."
     if not text:
         return ""
-    converter = marko.Markdown(
-        extensions=[
-            marko.helpers.MarkoExtension(
-                elements=[Url, Email, Tel, Ref, Incl],
-                renderer_mixins=[
-                    UrlRenderer,
-                    EmailRenderer,
-                    TelRenderer,
-                    RefRenderer,
-                    InclRenderer,
-                ],
-            )
-        ]
-    )
-    return converter(text)
+    return get_converter()(text)
+
+
+def get_version(itemid):
+    "Get the version of the item, or None if it does not exist."
+    try:
+        return items.get(itemid).version
+    except KeyError:
+        return None
+
+
+def get_html(item):
+    """Get the HTML for the text of the item, from the cache if still valid.
+    The cached HTML is valid if neither the item, nor any item referred to
+    or included in it, has been changed, created or deleted since rendering.
+    """
+    global _cache_size
+    with _cache_lock:
+        try:
+            version, dependencies, html = _cache[item.id]
+        except KeyError:
+            pass
+        else:
+            if version == item.version and all(
+                get_version(id) == v for id, v in dependencies
+            ):
+                _cache.move_to_end(item.id)
+                return html
+    version = item.version
+    dependencies = tuple([(id, get_version(id)) for id in item.ref_ids])
+    html = to_html(item.text)
+    with _cache_lock:
+        try:
+            _cache_size -= len(_cache.pop(item.id)[2])
+        except KeyError:
+            pass
+        _cache[item.id] = (version, dependencies, html)
+        _cache_size += len(html)
+        while _cache_size > constants.MAX_HTML_CACHE_SIZE and len(_cache) > 1:
+            _cache_size -= len(_cache.popitem(last=False)[1][2])
+    return html
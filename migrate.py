@@ -2,6 +2,7 @@
 
 import contextlib
 import os
+import pathlib
 
 import constants
 import items
@@ -14,28 +15,33 @@ CATEGORY_EVENT = dict(
 
 
 def migrate():
-    "Update all Markdown files to the new format. Handles all previous formats."
-    for path in constants.DATA_DIR.iterdir():
-        item = items.read_item(path)
-        if item is None:
-            continue
+    """Update all Markdown files to the new format. Handles all previous formats.
+    Operates on the items already read; if any was updated, the snapshot
+    is discarded and all items are read again.
+    """
+    updated = []
+    for item in items.get_items():
         # Remove 'filename' and add 'ext' instead; for File, Image and Database items.
         if "filename" in item.frontmatter:
-            with update(item):
+            with update(item, updated):
                 filename = item.frontmatter.pop("filename")
                 filename = pathlib.Path(filename)
                 item.ext = filename.suffix
+        # Record the MIME type from the file data; for File, Image and Database items.
+        if isinstance(item, items.GenericFile) and "mimetype" not in item.frontmatter:
+            if item.filepath.exists():  # Due to previous bug, the file may not exist.
+                with update(item, updated):
+                    item.frontmatter["mimetype"] = item.get_mimetype()
         # For Event items, remove timezone info from 'start' and 'end'.
         if isinstance(item, items.Event):
-            if item.start.tzinfo:
-                with update(item):
+            # Both in one update; the file must never have only one of them changed.
+            if item.start.tzinfo or item.end.tzinfo:
+                with update(item, updated):
                     item.frontmatter["start"] = item.start.replace(tzinfo=None)
-            if item.end.tzinfo:
-                with update(item):
                     item.frontmatter["end"] = item.end.replace(tzinfo=None)
             # For Event items, convert category to tag.
             if category := item.frontmatter.pop("category", None):
-                with update(item):
+                with update(item, updated):
                     tags = item.tag_ids
                     try:
                         tags.add(CATEGORY_EVENT[category])
@@ -45,12 +51,15 @@ def migrate():
         # For Book items, remove language
         if isinstance(item, items.Book):
             if "language" in item.frontmatter:
-                with update(item):
+                with update(item, updated):
                     item.frontmatter.pop("language")
+    if updated:
+        constants.SNAPSHOT_FILE.unlink(missing_ok=True)
+        items.read()
 
 
 @contextlib.contextmanager
-def update(item):
+def update(item, updated=None):
     "Update the contents of the Markdown file without changing the modification time."
     stat = item.path.stat()
     times = (stat.st_atime, stat.st_mtime)
@@ -59,3 +68,5 @@ def update(item):
     finally:
         item.write(refresh=False)
         os.utime(item.path, times=times)
+        if updated is not None:
+            updated.append(item)
@@ -1,9 +1,11 @@
 "chaos: Update the local directory from the www instance."
 
+import concurrent.futures
 from http import HTTPStatus as HTTP
-import io
+import json
 import os
 from pathlib import Path
+import shutil
 import sys
 import tarfile
 
@@ -18,88 +20,212 @@ if os.environ.get("CHAOS_DEVELOPMENT"):
     icecream.install()
 
 import constants
-import items
+import manifest
+import utils
 from timer import Timer
 
 timer = Timer()
 
+# File in the target directory recording the ETag and the content of the
+# remote manifest at the last successful update.
+MANIFEST_FILENAME = ".sync-manifest.json"
+
 
 def update(url, password, target_dir):
     """Get the current state of the remote site and update the local data.
+    The changed files are downloaded in parallel batches; each file is
+    written to a temporary file which is renamed when complete. An
+    interrupted update is resumed by the next call, since the files
+    already in place then are unchanged compared to the remote.
     Return a dictionary with statistics.
     """
-    response = requests.get(
-        url.rstrip("/") + "/api/all", headers=dict(password=password)
-    )
-    if response.status_code in (HTTP.BAD_GATEWAY, HTTP.SERVICE_UNAVAILABLE):
-        raise IOError(f"invalid response: {response.status_code=}")
-    elif response.status_code != HTTP.OK:
-        raise IOError(f"invalid response: {response.status_code=} {response.content=}")
-
-    remote_items = response.json()
-
+    url = url.rstrip("/")
     target_dir = Path(target_dir)
-    items.read(data_dir=target_dir)
-    local_items = items.get_all_files()
+    session = get_session(password)
+    manifest_file = target_dir / MANIFEST_FILENAME
+    try:
+        saved = json.loads(manifest_file.read_text())
+        headers = {"If-None-Match": saved["etag"]}
+    except (IOError, ValueError, KeyError, TypeError):
+        saved = None
+        headers = {}
+    response = session.get(url + "/api/all", headers=headers)
+    # The local files are always checked against the remote manifest, even if
+    # unchanged, so that a local file deleted or damaged is restored.
+    if response.status_code == HTTP.NOT_MODIFIED:
+        remote_items = saved["items"]
+        etag = None
+    else:
+        check_response(response)
+        remote_items = response.json()
+        etag = response.headers.get("ETag")
 
-    # Download the set of files with different 'modified' from the remote.
+    local_items = get_local_files(target_dir)
+
+    # Download the set of files with different 'modified' from the remote,
+    # unless the content hash shows that the file was only touched.
     download_items = set()
+    touched_items = set()
     for name, info in remote_items.items():
         modified = info["modified"]
         size = info["size"]
-        if (
-            (name not in local_items)
-            or (local_items[name]["modified"] != modified)
-            or (local_items[name]["size"] != size)
-        ):
+        if name not in local_items or local_items[name]["size"] != size:
             download_items.add(name)
+        elif local_items[name]["modified"] != modified:
+            path = get_path(target_dir, name)
+            if info.get("hash") and info["hash"] == manifest.compute_hash(path):
+                timestamp = utils.timestamp_from_iso_utc(modified)
+                os.utime(path, (timestamp, timestamp))
+                touched_items.add(name)
+            else:
+                download_items.add(name)
 
     if download_items:
-        response = requests.post(
-            url + "/api/download",
-            json={"items": list(download_items)},
-            headers=dict(password=password),
-        )
-        if response.status_code in (HTTP.BAD_GATEWAY, HTTP.SERVICE_UNAVAILABLE):
-            raise IOError(f"invalid response: {response.status_code=}")
-        elif response.status_code != HTTP.OK:
+        batches = get_batches(download_items, remote_items)
+        with concurrent.futures.ThreadPoolExecutor(constants.SYNC_WORKERS) as executor:
+            futures = [
+                executor.submit(download, session, url, target_dir, batch)
+                for batch in batches
+            ]
+            # Let all batches finish before reporting an error; the others are kept.
+            errors = [f.exception() for f in futures if f.exception() is not None]
+        if errors:
             raise IOError(
-                f"invalid response: {response.status_code=} {response.content=}"
+                f"{len(errors)} of {len(batches)} batches failed: {errors[0]}"
             )
 
-        if response.headers["Content-Type"] != constants.GZIP_MIMETYPE:
-            raise IOError("invalid file type from remote")
-
-        content = response.content
-        if not content:
-            raise IOError("empty TGZ file from remote")
-        try:
-            tf = tarfile.open(fileobj=io.BytesIO(content), mode="r:gz")
-            tf.extractall(path=target_dir)
-        except tarfile.TarError as message:
-            raise IOError(f"tar file error: {message}")
-
     # Delete local items that do not exist in the remote.
     delete_items = set(local_items.keys()).difference(remote_items.keys())
     for name in delete_items:
-        path = target_dir / name
-        if not path.suffix:
-            path = path.with_suffix(".md")
-        path.unlink()
+        get_path(target_dir, name).unlink()
 
-    if not download_items and not delete_items:
+    if etag:
+        tmppath = manifest_file.with_suffix(".tmp")
+        tmppath.write_text(json.dumps(dict(etag=etag, items=remote_items)))
+        os.replace(tmppath, manifest_file)
+
+    if not download_items and not delete_items and not touched_items:
         return {}
     else:
         result = {
             "local": len(local_items),
             "remote": len(remote_items),
             "downloaded": len(download_items),
+            "touched": len(touched_items),
             "deleted": len(delete_items),
         }
         result.update(timer.current)
     return result
 
 
+def get_session(password):
+    "Return an HTTP session with a connection pool for the parallel downloads."
+    session = requests.Session()
+    session.headers["password"] = password
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=constants.SYNC_WORKERS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def check_response(response):
+    "Raise IOError if the response is not OK."
+    if response.status_code in (HTTP.BAD_GATEWAY, HTTP.SERVICE_UNAVAILABLE):
+        raise IOError(f"invalid response: {response.status_code=}")
+    elif response.status_code != HTTP.OK:
+        raise IOError(f"invalid response: {response.status_code=} {response.content=}")
+
+
+def get_path(target_dir, name):
+    "Return the path of the named file in the target directory."
+    path = target_dir / name
+    if not path.suffix:
+        path = path.with_suffix(".md")
+    return path
+
+
+def get_local_files(target_dir):
+    """Get a map of the item names and filenames in the target directory with
+    their 'modified' and 'size' values, from the file system data only.
+    """
+    result = {}
+    with os.scandir(target_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+            name = entry.name
+            if name.endswith(".md"):
+                name = name[: -len(".md")]
+            stat = entry.stat()
+            result[name] = dict(
+                modified=utils.iso_utc_from_timestamp(stat.st_mtime),
+                size=stat.st_size,
+            )
+    return result
+
+
+def get_batches(names, remote_items):
+    """Split the names into batches bounded by total size and number of files.
+    Markdown files and other files are in separate batches, since the latter
+    are mostly compressed already and are downloaded without compression.
+    """
+    result = []
+    for markdown in (True, False):
+        batch = []
+        batch_size = 0
+        for name in sorted(names):
+            if bool(Path(name).suffix) == markdown:
+                continue
+            size = remote_items[name]["size"]
+            if batch and (
+                batch_size + size > constants.SYNC_BATCH_SIZE
+                or len(batch) >= constants.SYNC_BATCH_COUNT
+            ):
+                result.append(batch)
+                batch = []
+                batch_size = 0
+            batch.append(name)
+            batch_size += size
+        if batch:
+            result.append(batch)
+    return result
+
+
+def download(session, url, target_dir, batch):
+    """Download the batch of files as a TAR file, streaming each member into
+    a temporary file which is renamed when complete. Return the number of files.
+    """
+    compress = not Path(batch[0]).suffix
+    response = session.post(
+        url + "/api/download",
+        json={"items": batch, "compress": compress},
+        stream=True,
+    )
+    check_response(response)
+    if compress and response.headers["Content-Type"] != constants.GZIP_MIMETYPE:
+        raise IOError("invalid file type from remote")
+    elif not compress and response.headers["Content-Type"] != constants.TAR_MIMETYPE:
+        raise IOError("invalid file type from remote")
+
+    count = 0
+    try:
+        with response, tarfile.open(fileobj=response.raw, mode="r|*") as tf:
+            for member in tf:
+                # Only plain files directly in the target directory.
+                if not member.isfile() or Path(member.name).name != member.name:
+                    continue
+                path = target_dir / member.name
+                tmppath = target_dir / f".{member.name}.tmp"
+                with tmppath.open("wb") as outfile:
+                    shutil.copyfileobj(tf.extractfile(member), outfile)
+                os.utime(tmppath, (member.mtime, member.mtime))
+                os.replace(tmppath, path)
+                count += 1
+    except (tarfile.TarError, EOFError) as message:
+        raise IOError(f"tar file error: {message}")
+    return count
+
+
 if __name__ == "__main__":
     url = os.environ["CHAOS_REMOTE_URL"]
     target_dir = os.environ["CHAOS_TARGET_DIR"]
@@ -0,0 +1,126 @@
+"""Down-scaled variants of images in a few fixed widths, for 'srcset'.
+The variants are generated by a background thread, and are stored in the
+thumbnail directory keyed by the content hash of the image. A JSON file
+with the dimensions is written last, when all variants are in place.
+"""
+
+import json
+import mimetypes
+import queue
+import threading
+
+import PIL.Image
+import PIL.ImageOps
+
+import constants
+import manifest
+
+# Key: content hash; value: dictionary with the dimensions of the original
+# and the list of the widths of the variants.
+variants = {}
+# Paths of the images waiting to be processed.
+pending = set()
+pending_queue = queue.Queue()
+pending_lock = threading.Lock()
+# Tuples (path, mtime, size) of images for which the variants could not be created.
+failed = set()
+
+
+def get(image):
+    """Return the dictionary {hash, width, height, widths} for the variants
+    of the image, or None if not available. If not yet generated, request it.
+    """
+    if mimetypes.guess_type(image.filename)[0] not in constants.THUMBNAIL_MIMETYPES:
+        return None
+    path = image.filepath
+    try:
+        digest = manifest.get_hash(path, *image.stat(path), request=False)
+    except FileNotFoundError:
+        return None
+    if digest is not None:
+        try:
+            return variants[digest]
+        except KeyError:
+            pass
+        try:
+            result = json.loads(get_path(digest).read_text())
+            result["hash"] = digest
+            variants[digest] = result
+            return result
+        except (IOError, ValueError):
+            pass
+    with pending_lock:
+        if path not in pending and (path, *image.stat(path)) not in failed:
+            pending.add(path)
+            pending_queue.put(path)
+    return None
+
+
+def get_path(digest, width=None):
+    "Return the path of the variant of the given width, or of the JSON file."
+    if width is None:
+        return constants.THUMBNAIL_DIR / f"{digest}.json"
+    return constants.THUMBNAIL_DIR / f"{digest}-{width}{constants.THUMBNAIL_EXT}"
+
+
+def get_url(digest, width):
+    "Return the URL for the variant of the given width."
+    return f"/image/thumbnail/{digest}-{width}{constants.THUMBNAIL_EXT}"
+
+
+def create(path):
+    """Create the variants of the image narrower than the original,
+    and the JSON file with the dimensions.
+    """
+    stat = path.stat()
+    digest = manifest.get_hash(path, stat.st_mtime, stat.st_size, request=False)
+    if digest is None:
+        digest = manifest.compute_hash(path)
+        manifest.set_hash(path, digest)
+    if get_path(digest).exists():
+        return
+    with PIL.Image.open(path) as original:
+        original = PIL.ImageOps.exif_transpose(original)
+        if original.mode not in ("RGB", "RGBA"):
+            original = original.convert("RGBA")
+        width, height = original.size
+        widths = []
+        for variant_width in constants.THUMBNAIL_WIDTHS:
+            if variant_width >= width:
+                break
+            variant_height = max(1, round(height * variant_width / width))
+            variant = original.resize(
+                (variant_width, variant_height), PIL.Image.Resampling.LANCZOS
+            )
+            tmppath = get_path(digest, variant_width).with_suffix(".tmp")
+            variant.save(
+                tmppath,
+                format=constants.THUMBNAIL_FORMAT,
+                quality=constants.THUMBNAIL_QUALITY,
+            )
+            tmppath.replace(get_path(digest, variant_width))
+            widths.append(variant_width)
+    dimensions = dict(width=width, height=height, widths=widths)
+    get_path(digest).write_text(json.dumps(dimensions))
+
+
+def worker():
+    "Create the variants of the images in the queue, one at a time."
+    while True:
+        path = pending_queue.get()
+        try:
+            create(path)
+        except (OSError, PIL.UnidentifiedImageError, ValueError):
+            try:
+                stat = path.stat()
+                failed.add((path, stat.st_mtime, stat.st_size))
+            except OSError:
+                pass
+        with pending_lock:
+            pending.discard(path)
+
+
+def start():
+    "Create the thumbnail directory and start the background thread."
+    constants.THUMBNAIL_DIR.mkdir(exist_ok=True)
+    threading.Thread(target=worker, daemon=True).start()
@@ -18,6 +18,12 @@ def iso_utc_from_timestamp(timestamp):
     return dt.datetime.fromtimestamp(timestamp, tz=dt.UTC).strftime("%Y-%m-%d %H:%M:%S")
 
 
+def timestamp_from_iso_utc(iso):
+    "Convert ISO format string in UTC timezone to timestamp."
+    result = dt.datetime.strptime(iso, "%Y-%m-%d %H:%M:%S")
+    return result.replace(tzinfo=dt.UTC).timestamp()
+
+
 def get_datetime(year, month, day=1):
     "Return the datetime instance for the given day."
     return dt.datetime(year, month, day)